@@ -1,33 +1,252 @@
-import wave
+import hashlib
 import struct
-import magic  # Ensure to install python-magic
+import wave
 import os
+from functools import lru_cache
+import Lazy
+import Metrics
+
+np = Lazy.Module('numpy')
+
+WAV_MIME_TYPES = ('audio/wav', 'audio/x-wav')
+WAV_FORMATS = (0x0001, 0xFFFE)  # PCM and WAVE_FORMAT_EXTENSIBLE
+SNIFF_CHUNKS = 16
+
+# libmagic handle, loaded once on first use (python-magic is optional when
+# every upload passes the header sniff)
+@lru_cache(maxsize=None)
+def _magic():
+    import magic  # Ensure to install python-magic
+    return magic.Magic(mime=True)
+
+# Header-only WAV check: a RIFF/WAVE file whose 'fmt ' chunk describes PCM
+# audio. Only the chunk headers before 'fmt ' are read, however large the
+# file. Accepts a path or a seekable file object (left at its start).
+def sniff_wav(audio_file):
+    if not hasattr(audio_file, 'read'):
+        with open(audio_file, 'rb') as f:
+            return sniff_wav(f)
+    try:
+        riff, _, wave_id = struct.unpack('<4sL4s', audio_file.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            return False
+        for _ in range(SNIFF_CHUNKS):
+            chunk_id, size = struct.unpack('<4sL', audio_file.read(8))
+            if chunk_id == b'fmt ':
+                if size < 16:
+                    return False
+                format_tag, channels, framerate, _, block_align, bits = struct.unpack('<HHLLHH', audio_file.read(16))
+                return (format_tag in WAV_FORMATS and channels > 0 and framerate > 0
+                        and bits in (8, 16, 24, 32) and block_align == channels * bits // 8)
+            audio_file.seek(size + (size & 1), os.SEEK_CUR)
+        return False
+    except struct.error:
+        return False
+    finally:
+        audio_file.seek(0)
 
 # Convert audio file to binary (integer) data
 def is_valid_wav_file(file_path):
-    mime = magic.Magic(mime=True)
-    file_mime_type = mime.from_file(file_path)
-    return file_mime_type == 'audio/wav' or file_mime_type == 'audio/x-wav'
+    # The header sniff settles ordinary PCM files without loading libmagic
+    if sniff_wav(file_path):
+        return True
+    file_mime_type = _magic().from_file(file_path)
+    return file_mime_type in WAV_MIME_TYPES
+
+# Signed sample range for a WAV sample width (8-bit WAV is stored unsigned
+# with a bias of 128, wider samples are signed little-endian)
+def sample_range(sampwidth):
+    bits = 8 * sampwidth
+    return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+
+# Decode little-endian PCM bytes into an int64 array
+def _decode(audio_data, sampwidth, signed):
+    if sampwidth == 3:
+        raw = np.frombuffer(audio_data, dtype=np.uint8).reshape(-1, 3).astype(np.int64)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        return (values ^ 0x800000) - 0x800000 if signed else values
+    kind = 'i' if signed else 'u'
+    return np.frombuffer(audio_data, dtype=f'<{kind}{sampwidth}').astype(np.int64)
+
+# Encode integer values into little-endian PCM bytes
+def _encode(values, sampwidth, signed):
+    if sampwidth == 3:
+        return values.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    kind = 'i' if signed else 'u'
+    return values.astype(f'<{kind}{sampwidth}').tobytes()
+
+# Convert PCM bytes into signed integer samples
+def bytes_to_samples(audio_data, sampwidth=2):
+    if sampwidth == 1:
+        return _decode(audio_data, 1, False) - 128
+    return _decode(audio_data, sampwidth, True)
+
+# Convert signed integer samples into PCM bytes, clipping out-of-range values
+def samples_to_bytes(binary_data, sampwidth=2):
+    low, high = sample_range(sampwidth)
+    samples = np.clip(np.asarray(binary_data, dtype=np.int64), low, high)
+    if sampwidth == 1:
+        return _encode(samples + 128, 1, False)
+    return _encode(samples, sampwidth, True)
+
+# Shift signed samples into the non-negative range [0, 2^bits) used as plaintexts
+def to_offset(binary_data, sampwidth=2):
+    return np.asarray(binary_data, dtype=np.int64) - sample_range(sampwidth)[0]
+
+# Shift offset plaintexts back to signed samples
+def from_offset(offset_data, sampwidth=2):
+    return np.asarray(offset_data, dtype=np.int64) + sample_range(sampwidth)[0]
+
+# Offset samples as unsigned little-endian bytes (the hybrid mode plaintext)
+def offset_to_bytes(offset_data, sampwidth=2):
+    return _encode(np.asarray(offset_data, dtype=np.int64), sampwidth, False)
+
+def bytes_to_offset(data, sampwidth=2):
+    return _decode(data, sampwidth, False)
 
 def audio_to_binary(audio_file, log_file=''):
     # Ensure the file is a valid WAV file
     if not is_valid_wav_file(audio_file):
         raise ValueError("Uploaded file is not a valid WAV file.")
-    
-    with wave.open(audio_file, 'rb') as wave_file:
+
+    with Metrics.span('wav_read'), wave.open(audio_file, 'rb') as wave_file:
         params = wave_file.getparams()  # Store audio parameters
         audio_data = wave_file.readframes(wave_file.getnframes())
-        binary_data = struct.unpack('<' + 'h' * (len(audio_data) // 2), audio_data)  # Convert bytes to integers
+        binary_data = bytes_to_samples(audio_data, params.sampwidth)  # Convert bytes to integers
+    Metrics.count('wav_read', samples=len(binary_data), bytes_in=len(audio_data))
     return binary_data, params
 
 # Convert binary (integer) data back to audio and save as a .wav file
 def binary_to_audio(binary_data, params, output_file, log_file=''):
-    try:
-        audio_data = struct.pack('<' + 'h' * len(binary_data), *binary_data)
-    except struct.error as e:
-        binary_data = [max(-32768, min(32767, value)) for value in binary_data]
-        audio_data = struct.pack('<' + 'h' * len(binary_data), *binary_data)
+    with Metrics.span('wav_write'):
+        audio_data = samples_to_bytes(binary_data, params.sampwidth)
+
+        with wave.open(output_file, 'wb') as wave_file:
+            wave_file.setparams(params)  # Use original audio parameters
+            wave_file.writeframes(audio_data)
+    Metrics.count('wav_write', samples=len(binary_data), bytes_out=len(audio_data))
+
+# Number of frames read or written per chunk by the streaming functions
+CHUNK_FRAMES = 16384
+
+# Read the WAV parameters without loading any audio data
+def read_params(audio_file):
+    with wave.open(audio_file, 'rb') as wave_file:
+        return wave_file.getparams()
+
+# Open a WAV file or file-like object (such as an upload stream) and return
+# its parameters with a generator of integer samples, `chunk_frames` frames at a time.
+# A non-zero `start_frame` skips ahead (seekable files only).
+def open_samples(audio_file, chunk_frames=CHUNK_FRAMES, start_frame=0):
+    wave_file = wave.open(audio_file, 'rb')
+    params = wave_file.getparams()
+    if start_frame:
+        wave_file.setpos(start_frame)
 
+    def sample_chunks():
+        with wave_file:
+            while True:
+                with Metrics.span('wav_read'):
+                    audio_data = wave_file.readframes(chunk_frames)
+                    samples = bytes_to_samples(audio_data, params.sampwidth)
+                if not audio_data:
+                    return
+                Metrics.count('wav_read', samples=len(samples), bytes_in=len(audio_data))
+                yield samples
+
+    return params, sample_chunks()
+
+# Stream chunks of integer samples into a WAV file
+def write_samples(sample_chunks, params, output_file):
     with wave.open(output_file, 'wb') as wave_file:
-        wave_file.setparams(params)  # Use original audio parameters
-        wave_file.writeframes(audio_data)
+        wave_file.setparams(params)
+        for binary_data in sample_chunks:
+            with Metrics.span('wav_write'):
+                audio_data = samples_to_bytes(binary_data, params.sampwidth)
+                wave_file.writeframes(audio_data)
+            Metrics.count('wav_write', samples=len(binary_data), bytes_out=len(audio_data))
+
+# Canonical 44-byte PCM WAV header for `params`
+def wav_header(params):
+    data_length = params.nframes * params.nchannels * params.sampwidth
+    return struct.pack('<4sL4s4sLHHLLHH4sL', b'RIFF', 36 + data_length, b'WAVE', b'fmt ', 16, 1,
+                       params.nchannels, params.framerate,
+                       params.nchannels * params.framerate * params.sampwidth,
+                       params.nchannels * params.sampwidth, 8 * params.sampwidth,
+                       b'data', data_length)
+
+# Stream chunks of integer samples as WAV file bytes, one piece per chunk
+# (the header goes out with the first chunk). `params.nframes` must match the
+# frames produced, since the header cannot be patched afterwards.
+def iter_wav_bytes(sample_chunks, params):
+    pending = wav_header(params)
+    data_length = 0
+    for binary_data in sample_chunks:
+        with Metrics.span('wav_write'):
+            data = samples_to_bytes(binary_data, params.sampwidth)
+        Metrics.count('wav_write', samples=len(binary_data), bytes_out=len(data))
+        data_length += len(data)
+        yield pending + data
+        pending = b''
+    if data_length & 1:
+        pending += b'\x00'
+    if pending:
+        yield pending
+
+# Signal-to-noise ratio in dB from accumulated powers
+def snr_db(signal_power, noise_power):
+    if noise_power == 0:
+        return float('inf')  # Infinite SNR means no noise
+    if signal_power == 0:
+        return float('-inf')
+    return float(10 * np.log10(signal_power / noise_power))
+
+# Stream two WAV files (paths or file objects) side by side, `chunk_frames`
+# frames at a time, and report the overall and per-channel SNR, the maximum
+# absolute sample error and a BLAKE2b hash of each file's PCM data. Memory
+# use is constant in the file length.
+def compare_audio(original_file, decrypted_file, chunk_frames=CHUNK_FRAMES):
+    with wave.open(original_file, 'rb') as original, wave.open(decrypted_file, 'rb') as decrypted:
+        params = original.getparams()
+        if (decrypted.getnchannels(), decrypted.getsampwidth()) != (params.nchannels, params.sampwidth):
+            raise ValueError("The original and decrypted files have different formats.")
+        if decrypted.getnframes() != params.nframes:
+            raise ValueError("The original and decrypted files have different lengths.")
+
+        signal_power = np.zeros(params.nchannels)
+        noise_power = np.zeros(params.nchannels)
+        max_error = 0
+        original_hash = hashlib.blake2b()
+        decrypted_hash = hashlib.blake2b()
+        while True:
+            original_data = original.readframes(chunk_frames)
+            decrypted_data = decrypted.readframes(chunk_frames)
+            if not original_data and not decrypted_data:
+                break
+            if len(original_data) != len(decrypted_data):
+                raise ValueError("The original and decrypted files have different lengths.")
+            with Metrics.span('compare'):
+                original_hash.update(original_data)
+                decrypted_hash.update(decrypted_data)
+                signal = bytes_to_samples(original_data, params.sampwidth).reshape(-1, params.nchannels)
+                noise = signal - bytes_to_samples(decrypted_data, params.sampwidth).reshape(-1, params.nchannels)
+                # Square in float64: int16 (or wider) squares overflow their own type
+                signal = signal.astype(np.float64)
+                noise_float = noise.astype(np.float64)
+                signal_power += np.einsum('ij,ij->j', signal, signal)
+                noise_power += np.einsum('ij,ij->j', noise_float, noise_float)
+                if noise.size:
+                    max_error = max(max_error, int(np.abs(noise).max()))
+            Metrics.count('compare', samples=signal.size, bytes_in=len(original_data) + len(decrypted_data))
+
+    original_digest = original_hash.hexdigest()
+    decrypted_digest = decrypted_hash.hexdigest()
+    return {
+        'snr': snr_db(signal_power.sum(), noise_power.sum()),
+        'channel_snr': [snr_db(s, n) for s, n in zip(signal_power, noise_power)],
+        'max_abs_error': max_error,
+        'original_hash': original_digest,
+        'decrypted_hash': decrypted_digest,
+        'bit_exact': original_digest == decrypted_digest,
+        'frames': params.nframes,
+    }
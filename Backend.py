@@ -0,0 +1,70 @@
+import os
+import Lazy
+
+# Big-integer arithmetic backend. gmpy2 (GMP) is used when it is installed,
+# otherwise Python's built-in integers. The choice is made at import time
+# from ELGAMAL_BACKEND ('auto', 'gmpy2' or 'python') and can be changed at
+# runtime with set_backend(). Callers go through the module attributes
+# (Backend.powmod, ...) so that an override takes effect everywhere.
+
+# Optional dependency, imported on first use rather than at startup
+gmpy2 = Lazy.Module('gmpy2') if Lazy.available('gmpy2') else None
+
+BACKENDS = ('gmpy2', 'python')
+
+def available():
+    return [backend for backend in BACKENDS if backend != 'gmpy2' or gmpy2 is not None]
+
+def _python_invert(value, modulus):
+    try:
+        return pow(value, -1, modulus)
+    except ValueError:
+        raise ValueError(f"{value} has no inverse modulo {modulus}")
+
+# Jacobi symbol (a/n) for odd n > 0
+def _python_jacobi(a, n):
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+def _gmpy2_powmod(base, exponent, modulus):
+    return int(gmpy2.powmod(base, exponent, modulus))
+
+def _gmpy2_mpz(value):
+    return gmpy2.mpz(value)
+
+def _gmpy2_jacobi(a, n):
+    return int(gmpy2.jacobi(a, n))
+
+def _gmpy2_invert(value, modulus):
+    try:
+        return int(gmpy2.invert(value, modulus))
+    except ZeroDivisionError:
+        raise ValueError(f"{value} has no inverse modulo {modulus}")
+
+# Select a backend: 'gmpy2', 'python', or 'auto' for the fastest available
+def set_backend(backend='auto'):
+    global name, powmod, invert, mpz, jacobi
+    if backend == 'auto':
+        backend = 'gmpy2' if gmpy2 is not None else 'python'
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown arithmetic backend: {backend}")
+    if backend == 'gmpy2':
+        if gmpy2 is None:
+            raise ValueError("The gmpy2 backend needs the gmpy2 package (pip install gmpy2)")
+        powmod, invert, mpz, jacobi = _gmpy2_powmod, _gmpy2_invert, _gmpy2_mpz, _gmpy2_jacobi
+    else:
+        powmod, invert, mpz, jacobi = pow, _python_invert, int, _python_jacobi
+    name = backend
+    return name
+
+set_backend(os.environ.get('ELGAMAL_BACKEND', 'auto'))
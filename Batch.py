@@ -0,0 +1,356 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import Audio
+import Backend
+import Container
+import Elgamal
+
+# Non-interactive batch front end for scripted and nightly jobs. One key
+# file is generated once and reused; inputs may be files, directories
+# (searched recursively) or glob patterns, and files are processed
+# concurrently by a bounded pool of worker processes:
+#
+#   python Batch.py keygen --output keys.json --public-output public.json
+#   python Batch.py encrypt recordings/ --key public.json --output-dir archive/
+#   python Batch.py decrypt 'archive/**/*.bin' --key keys.json --output-dir restored/
+#   python Batch.py verify recordings/ --key keys.json --encrypted-dir archive/
+#
+# Archives can be refreshed or handed to a new key without decrypting them:
+#
+#   python Batch.py rerandomize archive/ --in-place
+#   python Batch.py rekeygen --key keys.json --new-key new.json --output rekey.json
+#   python Batch.py reencrypt archive/ --key rekey.json --output-dir handed-over/
+#
+# The re-encryption key file holds the target public key and the
+# re-encryption key rk = b - a, and lets a proxy move containers to the
+# target key without decrypting them. It is not safe against collusion:
+# rk together with either private key gives the other one, so the proxy must
+# be trusted not to work with the target key's holder, and making it needs
+# both private keys. Hybrid containers are re-keyed with the original key
+# pair file instead.
+# Each WAV file becomes <name>.wav.bin in the container format, keeping the
+# directory layout below a directory input or below the fixed part of a
+# glob pattern (archive/ in 'archive/**/*.bin'). Encryption is checkpointed, so
+# rerunning a job skips finished files and resumes interrupted ones.
+
+KEY_BITS = 128
+JOBS = int(os.environ.get('ELGAMAL_JOBS', os.cpu_count() or 1))
+AUDIO_SUFFIX = '.wav'
+CONTAINER_SUFFIX = '.bin'
+KEY_FIELDS = ('p', 'g', 'public_key')
+SECRET_FIELDS = ('private_key', 'reencryption_key')
+
+def write_key(path, key, private=None):
+    # Key files holding secrets (a private or re-encryption key) are only
+    # readable by their owner
+    if private is None:
+        private = any(field in key for field in SECRET_FIELDS)
+    mode = 0o600 if private else 0o644
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    # An existing file keeps its mode through O_CREAT, so set it explicitly
+    os.fchmod(fd, mode)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(key, f, indent=2)
+        f.write('\n')
+
+def load_key(path, private=False):
+    with open(path, 'r') as f:
+        key = json.load(f)
+    missing = [field for field in KEY_FIELDS + (('private_key',) if private else ()) if field not in key]
+    if missing:
+        raise ValueError(f"Key file {path} lacks {', '.join(missing)}")
+    return key
+
+# Directory a glob pattern's matches are named relative to: the part of the
+# pattern before its first wildcard
+def glob_root(pattern):
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+# Expand files, directories and glob patterns into (path, relative name)
+# pairs. Directories are searched recursively for files ending in `suffix`;
+# both keep the layout below the directory (or the pattern's fixed prefix).
+def expand_inputs(inputs, suffix):
+    found = {}
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if name.lower().endswith(suffix):
+                        path = os.path.join(root, name)
+                        found.setdefault(os.path.abspath(path), os.path.relpath(path, item))
+        else:
+            matches = sorted(glob.glob(item, recursive=True))
+            if not matches:
+                raise ValueError(f"No files match {item}")
+            root = glob_root(item)
+            for path in matches:
+                if os.path.isfile(path):
+                    found.setdefault(os.path.abspath(path), os.path.relpath(path, root))
+    return list(found.items())
+
+# Pair each input with its output path, refusing two inputs with one output
+def plan(inputs, suffix, output_dir, rename):
+    tasks = []
+    targets = {}
+    for path, relative in expand_inputs(inputs, suffix):
+        target = os.path.join(output_dir, rename(relative))
+        if target in targets:
+            raise ValueError(f"{path} and {targets[target]} would both be written to {target}")
+        targets[target] = path
+        tasks.append((path, target))
+    return tasks
+
+def container_name(relative):
+    return relative + CONTAINER_SUFFIX
+
+def audio_name(relative):
+    if relative.lower().endswith(CONTAINER_SUFFIX):
+        relative = relative[:-len(CONTAINER_SUFFIX)]
+    return relative if relative.lower().endswith(AUDIO_SUFFIX) else relative + AUDIO_SUFFIX
+
+# Per-file tasks. They run in the worker processes, so each one encrypts or
+# decrypts in-process (workers=1) and the pool provides the parallelism.
+
+def encrypt_one(source, target, mode, key, resume=True):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    p, g, public_key = key['p'], key['g'], key['public_key']
+    if not resume:
+        header = Container.encrypt_file(source, target, mode, p, g, public_key, workers=1)
+        status = 'encrypted'
+    else:
+        # Only a finished container for this source, mode and key is left as it is
+        manifest = Container.matching_manifest(target, Container.checkpoint_info(source, mode, p, g, public_key))
+        status = 'skipped' if manifest and manifest['complete'] else 'encrypted'
+        header = Container.encrypt_file_resumable(source, target, mode, p, g, public_key,
+                                                  private_key=key.get('private_key'), workers=1)
+    params = header.params
+    return {'status': status, 'samples': params.nframes * params.nchannels}
+
+def decrypt_one(source, target, key, start=None, end=None):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    if start is None and end is None:
+        params = Container.decrypt_file(source, key['private_key'], target, workers=1).params
+    else:
+        params = Container.decrypt_range(source, key['private_key'], target, start or 0, end, workers=1)
+    return {'status': 'decrypted', 'samples': params.nframes * params.nchannels}
+
+# Re-randomize a container, or move it to `key` when that is a re-encryption
+# key file (or, for hybrid containers, a key pair for the source key)
+def reencrypt_one(source, target, key=None):
+    if target != source:
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    key = key or {}
+    header = Container.reencrypt_file(source, target, key.get('target_public_key'),
+                                      key.get('reencryption_key', 0), key.get('private_key'), workers=1)
+    params = header.params
+    return {'status': 'reencrypted', 'samples': params.nframes * params.nchannels}
+
+# Decrypt a container to a temporary file and compare it with the original
+def verify_one(original, container, key):
+    if not os.path.exists(container):
+        raise ValueError(f"No container at {container}")
+    with tempfile.TemporaryDirectory() as directory:
+        decrypted = os.path.join(directory, 'decrypted.wav')
+        Container.decrypt_file(container, key['private_key'], decrypted, workers=1)
+        result = Audio.compare_audio(original, decrypted)
+    if not result['bit_exact']:
+        raise ValueError(f"Decrypted audio differs (SNR {result['snr']:.2f} dB, "
+                         f"max error {result['max_abs_error']})")
+    return {'status': 'verified', 'samples': result['frames'] * len(result['channel_snr'])}
+
+def _init_worker(backend):
+    Backend.set_backend(backend)
+
+# Run `function(*arguments)` for every task on at most `jobs` processes,
+# with at most 2 * jobs tasks queued, printing one progress line per file
+# and a summary. Returns the number of failed files.
+def run_tasks(function, tasks, jobs, label):
+    total = len(tasks)
+    started = time.perf_counter()
+    counts = {}
+    samples = 0
+    failures = 0
+
+    def report(name, outcome):
+        nonlocal samples, failures
+        done = sum(counts.values()) + 1
+        if isinstance(outcome, Exception):
+            failures += 1
+            counts['failed'] = counts.get('failed', 0) + 1
+            # Unexpected errors are named, as their message alone may be a bare key or value
+            if not isinstance(outcome, (ValueError, OSError, EOFError)):
+                outcome = f"{type(outcome).__name__}: {outcome}"
+            print(f"[{done}/{total}] failed {name}: {outcome}", file=sys.stderr)
+            return
+        counts[outcome['status']] = counts.get(outcome['status'], 0) + 1
+        if outcome['status'] != 'skipped':
+            samples += outcome['samples']
+        print(f"[{done}/{total}] {outcome['status']} {name}", file=sys.stderr)
+
+    if jobs <= 1 or total <= 1:
+        for name, arguments in tasks:
+            try:
+                outcome = function(*arguments)
+            except Exception as e:
+                # Any error fails this file only; the run and its summary go on
+                outcome = e
+            report(name, outcome)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(Backend.name,)) as executor:
+            pending = {}
+            queue = iter(tasks)
+            while True:
+                for name, arguments in queue:
+                    pending[executor.submit(function, *arguments)] = name
+                    if len(pending) >= 2 * jobs:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        outcome = e
+                    report(name, outcome)
+
+    elapsed = time.perf_counter() - started
+    details = ', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or 'no files'
+    print(f"{label}: {details} in {elapsed:.2f} s ({samples / elapsed if elapsed else 0:.0f} samples/s, "
+          f"{jobs} jobs)", file=sys.stderr)
+    return failures
+
+def keygen(options):
+    private_key, public_key, p, g = Elgamal.elgamal_keygen(options.bits)
+    write_key(options.output, {'p': p, 'g': g, 'public_key': public_key, 'private_key': private_key})
+    print(f"Key pair written to {options.output}", file=sys.stderr)
+    if options.public_output:
+        write_key(options.public_output, {'p': p, 'g': g, 'public_key': public_key})
+        print(f"Public key written to {options.public_output}", file=sys.stderr)
+    return 0
+
+def encrypt(options):
+    key = load_key(options.key)
+    tasks = [(source, (source, target, options.mode, key, options.resume))
+             for source, target in plan(options.inputs, AUDIO_SUFFIX, options.output_dir, container_name)]
+    return 1 if run_tasks(encrypt_one, tasks, options.jobs, 'encrypt') else 0
+
+def decrypt(options):
+    key = load_key(options.key, private=True)
+    tasks = [(source, (source, target, key, options.start, options.end))
+             for source, target in plan(options.inputs, CONTAINER_SUFFIX, options.output_dir, audio_name)]
+    return 1 if run_tasks(decrypt_one, tasks, options.jobs, 'decrypt') else 0
+
+# Both private keys are needed, and the output is as sensitive as either
+# of them (see the note at the top)
+def rekeygen(options):
+    old, new = load_key(options.key, private=True), load_key(options.new_key, private=True)
+    if (old['p'], old['g']) != (new['p'], new['g']):
+        raise ValueError("Both key pairs must share p and g.")
+    write_key(options.output, {
+        'p': old['p'], 'g': old['g'], 'public_key': old['public_key'],
+        'target_public_key': new['public_key'],
+        'reencryption_key': Container.reencryption_key(old['p'], old['private_key'], new['private_key']),
+    }, private=True)
+    print(f"Re-encryption key written to {options.output}", file=sys.stderr)
+    return 0
+
+def reencrypt_tasks(options, key):
+    if options.in_place:
+        return [(path, (path, path, key)) for path, _ in expand_inputs(options.inputs, CONTAINER_SUFFIX)]
+    return [(source, (source, target, key))
+            for source, target in plan(options.inputs, CONTAINER_SUFFIX, options.output_dir, lambda name: name)]
+
+def rerandomize(options):
+    key = load_key(options.key, private=True) if options.key else None
+    return 1 if run_tasks(reencrypt_one, reencrypt_tasks(options, key), options.jobs, 'rerandomize') else 0
+
+def reencrypt(options):
+    key = load_key(options.key)
+    if 'target_public_key' not in key and options.new_key:
+        # Hybrid re-keying: the source key pair plus the target public key
+        key = dict(load_key(options.key, private=True), target_public_key=load_key(options.new_key)['public_key'])
+    if 'target_public_key' not in key:
+        raise ValueError(f"Key file {options.key} is not a re-encryption key (see rekeygen) and no --new-key was given")
+    return 1 if run_tasks(reencrypt_one, reencrypt_tasks(options, key), options.jobs, 'reencrypt') else 0
+
+def verify(options):
+    key = load_key(options.key, private=True)
+    tasks = [(original, (original, container, key))
+             for original, container in plan(options.inputs, AUDIO_SUFFIX, options.encrypted_dir, container_name)]
+    return 1 if run_tasks(verify_one, tasks, options.jobs, 'verify') else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch ElGamal audio encryption')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    keygen_parser = commands.add_parser('keygen', help='generate a key pair to reuse across files')
+    keygen_parser.add_argument('--output', required=True, help='key pair file (JSON, private)')
+    keygen_parser.add_argument('--public-output', help='also write the public key alone to this file')
+    keygen_parser.add_argument('--bits', type=int, default=KEY_BITS)
+
+    def add_common(command_parser, what):
+        command_parser.add_argument('inputs', nargs='+', help=f'{what} files, directories or glob patterns')
+        command_parser.add_argument('--key', required=True, help='key file written by keygen')
+        command_parser.add_argument('--jobs', type=int, default=JOBS, help='files processed in parallel')
+
+    encrypt_parser = commands.add_parser('encrypt', help='encrypt WAV files into containers')
+    add_common(encrypt_parser, 'WAV')
+    encrypt_parser.add_argument('--output-dir', default='encrypted_files')
+    encrypt_parser.add_argument('--mode', choices=Container.MODES, default='sample')
+    encrypt_parser.add_argument('--no-resume', dest='resume', action='store_false',
+                                help='rewrite every container without checkpoints')
+
+    decrypt_parser = commands.add_parser('decrypt', help='decrypt containers into WAV files')
+    add_common(decrypt_parser, 'container')
+    decrypt_parser.add_argument('--output-dir', default='decrypted_files')
+    decrypt_parser.add_argument('--start', type=float, help='decrypt from this time in seconds')
+    decrypt_parser.add_argument('--end', type=float, help='decrypt up to this time in seconds')
+
+    verify_parser = commands.add_parser('verify', help='check that containers decrypt to the original WAV files')
+    add_common(verify_parser, 'original WAV')
+    verify_parser.add_argument('--encrypted-dir', default='encrypted_files')
+
+    rekeygen_parser = commands.add_parser('rekeygen', help='derive a re-encryption key between two key pairs')
+    rekeygen_parser.add_argument('--key', required=True, help='key pair the containers are encrypted under')
+    rekeygen_parser.add_argument('--new-key', required=True, help='key pair to move the containers to')
+    rekeygen_parser.add_argument('--output', required=True, help='re-encryption key file (JSON; secret, as it links both private keys)')
+
+    def add_reencrypt(command_parser):
+        command_parser.add_argument('inputs', nargs='+', help='container files, directories or glob patterns')
+        command_parser.add_argument('--jobs', type=int, default=JOBS, help='files processed in parallel')
+        target = command_parser.add_mutually_exclusive_group()
+        target.add_argument('--output-dir', default='reencrypted_files')
+        target.add_argument('--in-place', action='store_true', help='replace each container once it is rewritten')
+
+    rerandomize_parser = commands.add_parser('rerandomize', help='refresh the randomness of containers')
+    add_reencrypt(rerandomize_parser)
+    rerandomize_parser.add_argument('--key', help='key pair file (only needed for hybrid containers)')
+
+    reencrypt_parser = commands.add_parser('reencrypt', help='move containers to another key without decrypting')
+    add_reencrypt(reencrypt_parser)
+    reencrypt_parser.add_argument('--key', required=True,
+                                  help='re-encryption key file from rekeygen, or the source key pair for hybrid')
+    reencrypt_parser.add_argument('--new-key', help='target key file (hybrid containers with a key pair --key)')
+
+    options = parser.parse_args(argv)
+    handlers = {'keygen': keygen, 'encrypt': encrypt, 'decrypt': decrypt, 'verify': verify,
+                'rekeygen': rekeygen, 'rerandomize': rerandomize, 'reencrypt': reencrypt}
+    try:
+        return handlers[options.command](options)
+    except (ValueError, OSError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
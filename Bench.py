@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+import numpy as np
+import Audio
+import Backend
+import ECElgamal
+import Elgamal
+import Engine
+import ExpElgamal
+import Params
+
+# Benchmark harness. Times group parameter and key generation, single and
+# batch ElGamal, re-randomization and re-encryption, homomorphic sums under
+# exponential ElGamal, the arithmetic backends, EC-ElGamal, WAV conversion,
+# the streaming Flask routes on synthetic WAV input and the cold start of
+# the entry points, and writes the results as JSON. `compare` checks a run
+# against a stored baseline and exits non-zero on regressions, so it can
+# gate upgrades:
+#
+#   python Bench.py run --output baseline.json
+#   python Bench.py run --baseline baseline.json
+
+KEY_BITS = (128, 256, 512)
+BACKEND_BITS = (256, 1024, 2048)
+STARTUP_MODULES = ('Container', 'elgamal_audio_encryption', 'home')
+MIN_TIME = 1.0
+MIN_RUNS = 3
+MAX_RUNS = 10000
+THRESHOLD = 0.15
+MIN_ALLOC_KB = 64
+
+# Peak resident set size of this process so far, in KiB. It never goes
+# down, so it is only recorded once for the whole run.
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# Peak memory allocated by this process during one call of `function`, in
+# KiB. tracemalloc sees Python objects and NumPy arrays but not the Engine
+# worker processes. It slows calls down, so it gets a call of its own.
+def peak_alloc_kb(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+# Call `function` repeatedly for at least `min_time` seconds and summarise
+# the per-call latencies. `samples` is the number of audio samples per call.
+def measure(name, function, samples=0, min_time=MIN_TIME, min_runs=MIN_RUNS, max_runs=MAX_RUNS):
+    function()  # warm-up: fills caches, pools and fixed-base tables
+    timings = []
+    while len(timings) < min_runs or (sum(timings) < min_time and len(timings) < max_runs):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    total = sum(timings)
+    result = {
+        'name': name,
+        'runs': len(timings),
+        'ops_per_sec': len(timings) / total,
+        'p50_ms': 1000 * percentile(timings, 0.50),
+        'p99_ms': 1000 * percentile(timings, 0.99),
+        'peak_alloc_kb': peak_alloc_kb(function),
+    }
+    if samples:
+        result['samples_per_sec'] = samples * len(timings) / total
+    return result
+
+# Write a WAV file of uniformly random samples
+def make_wav(path, frames, channels=1, sampwidth=2, framerate=44100, seed=0):
+    low, high = Audio.sample_range(sampwidth)
+    samples = np.random.default_rng(seed).integers(low, high, size=frames * channels, endpoint=True)
+    with wave.open(path, 'wb') as wave_file:
+        wave_file.setnchannels(channels)
+        wave_file.setsampwidth(sampwidth)
+        wave_file.setframerate(framerate)
+        wave_file.writeframes(Audio.samples_to_bytes(samples, sampwidth))
+
+# Group parameter generation (a fresh safe prime and generator, bypassing
+# the cache) and key pair generation from the cached group, per bit length
+def bench_keygen(options):
+    for bits in options.bits:
+        yield measure(f'params_{bits}', lambda: Params.generate_group(bits), min_time=options.min_time)
+        yield measure(f'keygen_{bits}', lambda: Elgamal.elgamal_keygen(bits), min_time=options.min_time)
+
+def bench_elgamal(options):
+    private_key, public_key, p, g = Elgamal.elgamal_keygen(options.key_bits)
+    rng = np.random.default_rng(1)
+    message = int(rng.integers(0, 1 << 16))
+    c1, c2 = Elgamal.elgamal_encrypt(p, g, public_key, message)
+    yield measure('encrypt_single', lambda: Elgamal.elgamal_encrypt(p, g, public_key, message),
+                  samples=1, min_time=options.min_time)
+    yield measure('decrypt_single', lambda: Elgamal.elgamal_decrypt(p, private_key, c1, c2),
+                  samples=1, min_time=options.min_time)
+
+    messages = rng.integers(0, 1 << 16, size=options.batch).tolist()
+    pairs = Engine.parallel_encrypt(p, g, public_key, messages, options.workers)
+    yield measure('encrypt_batch', lambda: Engine.parallel_encrypt(p, g, public_key, messages, options.workers),
+                  samples=len(messages), min_time=options.min_time)
+    yield measure('decrypt_batch', lambda: Engine.parallel_decrypt(p, private_key, pairs, options.workers),
+                  samples=len(pairs), min_time=options.min_time)
+
+    # Re-randomizing the batch under the same key, and moving it to another
+    # key with a re-encryption key, without decrypting it
+    new_private_key = int(rng.integers(2, 1 << 62))
+    new_public_key = pow(g, new_private_key, p)
+    rekey = (new_private_key - private_key) % (p - 1)
+    pair_chunks = [pairs[start:start + Engine.CHUNK_SIZE] for start in range(0, len(pairs), Engine.CHUNK_SIZE)]
+    yield measure('rerandomize_batch',
+                  lambda: list(Engine.imap_rerandomize(p, g, public_key, pair_chunks, 0, options.workers)),
+                  samples=len(pairs), min_time=options.min_time)
+    yield measure('reencrypt_batch',
+                  lambda: list(Engine.imap_rerandomize(p, g, new_public_key, pair_chunks, rekey, options.workers)),
+                  samples=len(pairs), min_time=options.min_time)
+
+    # Exponential ElGamal: one homomorphic sum over the batch and its
+    # baby-step giant-step decryption (the first call builds the table)
+    additive = ExpElgamal.encrypt_many(p, g, public_key, messages, options.workers)
+    total = ExpElgamal.combine(p, additive)
+    bound = len(messages) << 16
+    yield measure('additive_sum', lambda: ExpElgamal.combine(p, additive),
+                  samples=len(additive), min_time=options.min_time)
+    yield measure('additive_decrypt_sum', lambda: ExpElgamal.decrypt(p, g, private_key, total, bound),
+                  min_time=options.min_time)
+
+# Modular exponentiation, inversion and table-based encryption under each
+# available arithmetic backend
+def bench_backends(options):
+    previous = Backend.name
+    try:
+        for bits in options.backend_bits:
+            p = Params.random_prime(bits)
+            rng = random.Random(bits)
+            base, exponent = rng.randrange(2, p - 1), rng.randrange(2, p - 1)
+            for backend in Backend.available():
+                Backend.set_backend(backend)
+                key = Elgamal.ElGamalPublicKey(p, base, Backend.powmod(base, exponent, p))
+                benches = [
+                    (f'powmod_{bits}_{backend}', lambda: Backend.powmod(base, exponent, p)),
+                    (f'invert_{bits}_{backend}', lambda: Backend.invert(base, p)),
+                    (f'encrypt_table_{bits}_{backend}', lambda: key.encrypt(12345)),
+                ]
+                for name, function in benches:
+                    result = measure(name, function, min_time=options.min_time)
+                    result['backend'] = backend
+                    yield result
+    finally:
+        Backend.set_backend(previous)
+
+# EC-ElGamal over P-256: keygen, single and packed encrypt/decrypt, with the
+# ciphertext bytes per sample of the packed encoding
+def bench_ec(options):
+    curve = ECElgamal.P256
+    private_key, public_key, _, g = ECElgamal.elgamal_keygen(curve)
+    key = ECElgamal.get_public_key(curve, public_key)
+    c1, c2 = key.encrypt(12345)
+    samples = np.random.default_rng(2).integers(0, 1 << 16, size=options.batch // 16).tolist()
+    width, count, pairs = ECElgamal.elgamal_encrypt_packed(curve, g, public_key, samples)
+
+    yield measure('ec_keygen', lambda: ECElgamal.elgamal_keygen(curve), min_time=options.min_time)
+    yield measure('ec_encrypt_single', lambda: key.encrypt(12345), samples=1, min_time=options.min_time)
+    yield measure('ec_decrypt_single', lambda: ECElgamal.elgamal_decrypt(curve, private_key, c1, c2),
+                  samples=1, min_time=options.min_time)
+    result = measure('ec_encrypt_packed', lambda: ECElgamal.elgamal_encrypt_packed(curve, g, public_key, samples),
+                     samples=len(samples), min_time=options.min_time)
+    result['ciphertext_bytes_per_sample'] = len(ECElgamal.encode_pairs(curve, pairs)) / len(samples)
+    yield result
+    yield measure('ec_decrypt_packed',
+                  lambda: ECElgamal.elgamal_decrypt_packed(curve, private_key, pairs, width, count),
+                  samples=len(samples), min_time=options.min_time)
+
+# Throughput ratio of each gmpy2 benchmark over its pure-Python counterpart
+def backend_speedups(results):
+    by_name = {result['name']: result for result in results}
+    speedups = {}
+    for name, result in by_name.items():
+        if name.endswith('_gmpy2'):
+            base = by_name.get(name[:-len('gmpy2')] + 'python')
+            if base:
+                speedups[name[:-len('_gmpy2')]] = result['ops_per_sec'] / base['ops_per_sec']
+    return speedups
+
+def bench_audio(options, wav_path, directory):
+    samples = options.frames * options.channels
+    binary_data, params = Audio.audio_to_binary(wav_path)
+    output_path = os.path.join(directory, 'output.wav')
+    yield measure('audio_to_binary', lambda: Audio.audio_to_binary(wav_path),
+                  samples=samples, min_time=options.min_time)
+    yield measure('binary_to_audio', lambda: Audio.binary_to_audio(binary_data, params, output_path),
+                  samples=samples, min_time=options.min_time)
+
+# End-to-end streaming routes through the Flask test client
+def bench_routes(options, wav_path):
+    import home
+
+    samples = options.frames * options.channels
+    client = home.app.test_client()
+    with open(wav_path, 'rb') as f:
+        audio = f.read()
+    for mode in options.modes:
+        private_key = client.get('/generate-keys').get_json()['private_key']
+        encrypted = client.post(f'/encrypt-stream?mode={mode}', data=audio).data
+
+        def encrypt():
+            response = client.post(f'/encrypt-stream?mode={mode}', data=audio)
+            response.get_data()  # consume the streamed body
+            if response.status_code != 200:
+                raise RuntimeError(f'/encrypt-stream failed: {response.get_data(as_text=True)}')
+
+        def decrypt():
+            response = client.post('/decrypt-stream', data=encrypted, headers={'X-Private-Key': private_key})
+            response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f'/decrypt-stream failed: {response.get_data(as_text=True)}')
+
+        yield measure(f'route_encrypt_{mode}', encrypt, samples=samples, min_time=options.min_time)
+        yield measure(f'route_decrypt_{mode}', decrypt, samples=samples, min_time=options.min_time)
+
+# Cold start: a fresh interpreter per run, bare and importing each entry
+# point. `import_ms` is the import alone, as timed inside the child. Runs in
+# `directory` because importing home creates its working directories.
+def bench_startup(options, directory):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get('PYTHONPATH')])))
+    yield measure('startup_python', lambda: subprocess.run([sys.executable, '-c', 'pass'], check=True),
+                  min_time=options.min_time)
+    for module in STARTUP_MODULES:
+        code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+        imports = []
+
+        def start():
+            child = subprocess.run([sys.executable, '-c', code], cwd=directory, env=env,
+                                   check=True, capture_output=True, text=True)
+            imports.append(float(child.stdout))
+
+        result = measure(f'startup_{module}', start, min_time=options.min_time)
+        result['import_ms'] = 1000 * percentile(imports, 0.50)
+        yield result
+
+GROUPS = ('keygen', 'elgamal', 'backend', 'ec', 'audio', 'routes', 'startup')
+
+def run(options):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        wav_path = os.path.join(directory, 'input.wav')
+        make_wav(wav_path, options.frames, options.channels, options.sampwidth)
+        benches = {
+            'keygen': lambda: bench_keygen(options),
+            'elgamal': lambda: bench_elgamal(options),
+            'backend': lambda: bench_backends(options),
+            'ec': lambda: bench_ec(options),
+            'audio': lambda: bench_audio(options, wav_path, directory),
+            'routes': lambda: bench_routes(options, wav_path),
+            'startup': lambda: bench_startup(options, directory),
+        }
+        for group in options.only or GROUPS:
+            for result in benches[group]():
+                print(f"{result['name']:<24} {result['ops_per_sec']:>12.2f} ops/s  "
+                      f"p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms", file=sys.stderr)
+                results.append(result)
+    Engine.shutdown()
+    speedups = backend_speedups(results)
+    for name, speedup in sorted(speedups.items()):
+        print(f"gmpy2 speedup {name:<24} {speedup:8.2f}x", file=sys.stderr)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'config': {
+            'bits': options.bits, 'key_bits': options.key_bits, 'batch': options.batch,
+            'frames': options.frames, 'channels': options.channels, 'sampwidth': options.sampwidth,
+            'modes': options.modes, 'workers': options.workers,
+            'backend': Backend.name, 'backend_bits': options.backend_bits,
+        },
+        'backend_speedup': speedups,
+        'peak_rss_kb': peak_rss_kb(),
+        'results': results,
+    }
+
+# Compare two result documents. A benchmark regresses when its throughput
+# drops, or its p99 latency or peak allocation grows, by more than `threshold`;
+# the run as a whole regresses when its peak RSS grows by that much.
+# Allocations below MIN_ALLOC_KB are too small to compare meaningfully.
+HIGHER_IS_BETTER = {'ops_per_sec': True, 'p99_ms': False, 'peak_alloc_kb': False}
+
+def compare(baseline, current, threshold=THRESHOLD):
+    previous = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        base = previous.get(result['name'])
+        if base is None:
+            continue
+        for metric, higher_is_better in HIGHER_IS_BETTER.items():
+            if not base.get(metric) or metric not in result:
+                continue
+            if metric == 'peak_alloc_kb' and max(base[metric], result[metric]) < MIN_ALLOC_KB:
+                continue
+            change = result[metric] / base[metric] - 1
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append({'name': result['name'], 'metric': metric,
+                                    'baseline': base[metric], 'current': result[metric], 'change': change})
+    if baseline.get('peak_rss_kb') and 'peak_rss_kb' in current:
+        change = current['peak_rss_kb'] / baseline['peak_rss_kb'] - 1
+        if change > threshold:
+            regressions.append({'name': 'run', 'metric': 'peak_rss_kb',
+                                'baseline': baseline['peak_rss_kb'], 'current': current['peak_rss_kb'],
+                                'change': change})
+    return regressions
+
+def report(regressions):
+    for regression in regressions:
+        print(f"REGRESSION {regression['name']} {regression['metric']}: "
+              f"{regression['baseline']:.3f} -> {regression['current']:.3f} "
+              f"({100 * regression['change']:+.1f}%)", file=sys.stderr)
+    if not regressions:
+        print("No regressions.", file=sys.stderr)
+    return 1 if regressions else 0
+
+def load(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ElGamal audio encryption benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and print JSON results')
+    run_parser.add_argument('--output', help='write the JSON results to this file')
+    run_parser.add_argument('--baseline', help='compare the results against this baseline file')
+    run_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    run_parser.add_argument('--only', nargs='+', choices=GROUPS, help='benchmark groups to run')
+    run_parser.add_argument('--bits', nargs='+', type=int, default=list(KEY_BITS), help='keygen bit lengths')
+    run_parser.add_argument('--backend-bits', nargs='+', type=int, default=list(BACKEND_BITS),
+                            help='modulus sizes for the backend comparison')
+    run_parser.add_argument('--key-bits', type=int, default=128, help='key size for the other benchmarks')
+    run_parser.add_argument('--batch', type=int, default=4096, help='messages per batch call')
+    run_parser.add_argument('--frames', type=int, default=8192, help='frames in the synthetic WAV')
+    run_parser.add_argument('--channels', type=int, default=1)
+    run_parser.add_argument('--sampwidth', type=int, default=2, choices=(1, 2, 3, 4))
+    run_parser.add_argument('--modes', nargs='+', default=['sample', 'packed', 'hybrid'])
+    run_parser.add_argument('--workers', type=int, default=None)
+    run_parser.add_argument('--min-time', type=float, default=MIN_TIME, help='seconds per benchmark')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+
+    options = parser.parse_args(argv)
+    if options.command == 'compare':
+        return report(compare(load(options.baseline), load(options.current), options.threshold))
+
+    results = run(options)
+    document = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+    if options.baseline:
+        return report(compare(load(options.baseline), results, options.threshold))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,783 @@
+import bisect
+import json
+import math
+import os
+import struct
+import wave
+from collections import deque, namedtuple
+import Audio
+import Backend
+import Elgamal
+import Engine
+import ExpElgamal
+import Hybrid
+import Lazy
+import Metrics
+
+np = Lazy.Module('numpy')
+
+# Versioned binary ciphertext container.
+#
+# File layout (all integers big-endian):
+#   magic 'EGAC' | version (u8) | header length (u32) | header
+#   header: mode (u8) | limb size (u16) | p | g | public key
+#           | nchannels (u16) | sampwidth (u16) | framerate (u32) | nframes (u32)
+#           | packing width (u16) | encapsulated key c1
+#   (p, g, public key and c1 are u16 length-prefixed integers)
+# followed by chunk records:
+#   chunk index (u32) | sample count (u32) | record count (u32) | payload length (u32) | payload
+#
+# For the 'sample', 'packed' and 'additive' modes the payload is
+# record_count (c1, c2) pairs stored as fixed-width limbs of `limb size`
+# bytes; for 'hybrid' it is the chunk ciphertext followed by its
+# authentication tag, which since version 2 also covers the WAV parameters
+# of the header and the chunk's sample count. 'additive' holds one exponential-ElGamal ciphertext
+# per sample, so windowed sums can be computed without the key.
+#
+# Checkpointed encryption (encrypt_file_resumable) also keeps two sidecar
+# files next to the container:
+#   <container>.idx            one entry per committed chunk:
+#                              chunk index (u32) | file offset (u64) | first sample (u64) | sample count (u32)
+#   <container>.manifest.json  source, key, mode and how far the container is committed
+# The index lets a time range be decrypted without reading the whole
+# container; without it the chunk offsets are found by skipping over the
+# chunk payloads.
+
+MAGIC = b'EGAC'
+VERSION = 2
+# Version 1 differs only in the hybrid tags, which cover less
+READ_VERSIONS = (1, 2)
+MODES = ('sample', 'packed', 'hybrid', 'additive')
+CHUNK_RECORDS = 4096
+
+_PREFIX = struct.Struct('>4sBI')
+_PARAMS = struct.Struct('>HHII')
+_CHUNK = struct.Struct('>IIII')
+_INDEX = struct.Struct('>IQQI')
+
+INDEX_SUFFIX = '.idx'
+MANIFEST_SUFFIX = '.manifest.json'
+
+ContainerHeader = namedtuple('ContainerHeader', 'mode p g public_key params packing_width kem_c1 version',
+                             defaults=(VERSION,))
+Chunk = namedtuple('Chunk', 'index sample_count records')
+IndexEntry = namedtuple('IndexEntry', 'index offset first_sample sample_count')
+
+# Number of bytes used for each c1/c2 limb
+def limb_size(p):
+    return (p.bit_length() + 7) // 8
+
+def _pack_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return struct.pack('>H', len(data)) + data
+
+def _unpack_int(view, offset):
+    (length,) = struct.unpack_from('>H', view, offset)
+    offset += 2
+    if offset + length > len(view):
+        raise ValueError("Truncated ciphertext container.")
+    return int.from_bytes(view[offset:offset + length], 'big'), offset + length
+
+# Read up to `size` bytes; streams such as uploads may return short reads
+def _read_upto(f, size):
+    data = f.read(size)
+    while data and len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def _read_exact(f, size):
+    data = _read_upto(f, size)
+    if len(data) != size:
+        raise ValueError("Truncated ciphertext container.")
+    return data
+
+def make_header(mode, p, g, public_key, params, packing_width=0, kem_c1=0):
+    if mode not in MODES:
+        raise ValueError(f"Unknown encryption mode: {mode}")
+    return ContainerHeader(mode, p, g, public_key, params, packing_width, kem_c1)
+
+# Check whether a file starts with the container magic
+def is_container(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# Encode (c1, c2) pairs as fixed-width big-endian limbs
+def encode_pairs(pairs, size):
+    return b''.join(value.to_bytes(size, 'big') for pair in pairs for value in pair)
+
+# Decode fixed-width limbs back into (c1, c2) pairs with bulk reads
+def decode_pairs(payload, size):
+    if size in (1, 2, 4, 8):
+        values = np.frombuffer(payload, dtype=f'>u{size}').tolist()
+    else:
+        view = memoryview(payload)
+        values = [int.from_bytes(view[i:i + size], 'big') for i in range(0, len(view), size)]
+    return list(zip(values[0::2], values[1::2]))
+
+def encode_header(header):
+    params = header.params
+    body = b''.join([
+        struct.pack('>BH', MODES.index(header.mode), limb_size(header.p)),
+        _pack_int(header.p), _pack_int(header.g), _pack_int(header.public_key),
+        _PARAMS.pack(params.nchannels, params.sampwidth, params.framerate, params.nframes),
+        struct.pack('>H', header.packing_width),
+        _pack_int(header.kem_c1),
+    ])
+    return _PREFIX.pack(MAGIC, header.version, len(body)) + body
+
+def write_header(f, header):
+    f.write(encode_header(header))
+
+def read_header(f):
+    magic, version, length = _PREFIX.unpack(_read_exact(f, _PREFIX.size))
+    if magic != MAGIC:
+        raise ValueError("Not an encrypted audio container.")
+    if version not in READ_VERSIONS:
+        raise ValueError(f"Unsupported container version: {version}")
+    view = memoryview(_read_exact(f, length))
+    try:
+        mode, _ = struct.unpack_from('>BH', view, 0)
+        if mode >= len(MODES):
+            raise ValueError(f"Unknown encryption mode in container: {mode}")
+        offset = 3
+        p, offset = _unpack_int(view, offset)
+        g, offset = _unpack_int(view, offset)
+        public_key, offset = _unpack_int(view, offset)
+        nchannels, sampwidth, framerate, nframes = _PARAMS.unpack_from(view, offset)
+        offset += _PARAMS.size
+        (packing_width,) = struct.unpack_from('>H', view, offset)
+        kem_c1, offset = _unpack_int(view, offset + 2)
+    except struct.error:
+        # The header is shorter than its fields (a cut-off or corrupt file)
+        raise ValueError("Truncated ciphertext container.") from None
+    params = wave._wave_params(nchannels, sampwidth, framerate, nframes, 'NONE', 'not compressed')
+    return ContainerHeader(MODES[mode], p, g, public_key, params, packing_width, kem_c1, version)
+
+# Data a hybrid chunk's tag authenticates besides its index and ciphertext,
+# so the WAV parameters and sample counts cannot be changed undetected
+def associated_data(header, sample_count):
+    if header.version < 2:
+        return b''
+    params = header.params
+    return (_PARAMS.pack(params.nchannels, params.sampwidth, params.framerate, params.nframes)
+            + struct.pack('>I', sample_count))
+
+# Pass chunks through, checking that they carry consecutive indices from
+# `first_index`. Hybrid tags only bind a chunk to the index stored with it,
+# so this is what stops chunks from being swapped along with their indices.
+def _in_order(chunks, first_index=0):
+    for expected, chunk in enumerate(chunks, first_index):
+        if chunk.index != expected:
+            raise ValueError(f"Chunk {chunk.index} found where chunk {expected} was expected.")
+        yield chunk
+
+def encode_chunk(header, chunk):
+    with Metrics.span('serialize'):
+        if header.mode == 'hybrid':
+            ciphertext, tag = chunk.records
+            payload = ciphertext + tag
+            count = 1
+        else:
+            payload = encode_pairs(chunk.records, limb_size(header.p))
+            count = len(chunk.records)
+        data = _CHUNK.pack(chunk.index, chunk.sample_count, count, len(payload)) + payload
+    Metrics.count('serialize', bytes_out=len(data))
+    return data
+
+def write_chunk(f, header, chunk):
+    f.write(encode_chunk(header, chunk))
+
+# Read the next chunk of an open container, or None at the end
+def read_chunk(f, header):
+    with Metrics.span('parse'):
+        prefix = _read_upto(f, _CHUNK.size)
+        if not prefix:
+            return None
+        if len(prefix) != _CHUNK.size:
+            raise ValueError("Truncated ciphertext container.")
+        index, sample_count, count, length = _CHUNK.unpack(prefix)
+        payload = _read_exact(f, length)
+        if header.mode == 'hybrid':
+            records = (payload[:-Hybrid.TAG_SIZE], payload[-Hybrid.TAG_SIZE:])
+        else:
+            if length != count * 2 * limb_size(header.p):
+                raise ValueError(f"Corrupt payload length in chunk {index}.")
+            records = decode_pairs(payload, limb_size(header.p))
+    Metrics.count('parse', bytes_in=_CHUNK.size + length)
+    return Chunk(index, sample_count, records)
+
+# Yield the chunks of an open container one at a time
+def iter_chunks(f, header):
+    while True:
+        chunk = read_chunk(f, header)
+        if chunk is None:
+            return
+        yield chunk
+
+# Split a flat list of records into chunks covering `total_samples` samples
+def split_chunks(records, total_samples, samples_per_record=1, chunk_records=CHUNK_RECORDS):
+    chunks = []
+    for index, start in enumerate(range(0, len(records), chunk_records)):
+        block = records[start:start + chunk_records]
+        first_sample = start * samples_per_record
+        sample_count = min(len(block) * samples_per_record, total_samples - first_sample)
+        chunks.append(Chunk(index, sample_count, block))
+    return chunks
+
+# Build the chunks for hybrid (ciphertext, tag) records
+def hybrid_chunks(records, total_samples, chunk_samples=Hybrid.CHUNK_SAMPLES):
+    return [Chunk(index, min(chunk_samples, total_samples - index * chunk_samples), record)
+            for index, record in enumerate(records)]
+
+# Import the legacy text format ("c1 c2" per line, optional packed/hybrid
+# header line). Text files carry no key or WAV parameters, so the caller
+# supplies them; the result can then be re-saved as a container.
+def import_text(path, p, g, public_key, params):
+    mode, packing_width, kem_c1, count = 'sample', 0, 0, None
+    records = []
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            parts = line.strip().split()
+            if len(parts) == 3 and parts[0] == 'packed':
+                mode, packing_width, count = 'packed', int(parts[1]), int(parts[2])
+                continue
+            if len(parts) == 3 and parts[0] == 'hybrid':
+                mode, kem_c1 = 'hybrid', int(parts[1])
+                continue
+            if len(parts) != 2:
+                continue
+            try:
+                if mode == 'hybrid':
+                    records.append((bytes.fromhex(parts[0]), bytes.fromhex(parts[1])))
+                else:
+                    records.append((int(parts[0]), int(parts[1])))
+            except ValueError:
+                continue
+
+    # Legacy hybrid tags carry no associated data, as in container version 1
+    header = make_header(mode, p, g, public_key, params, packing_width, kem_c1)._replace(version=1)
+    if mode == 'hybrid':
+        total = sum(len(ciphertext) // 2 for ciphertext, _ in records)
+        return header, hybrid_chunks(records, total)
+    if mode == 'packed':
+        return header, split_chunks(records, count, packing_width)
+    return header, split_chunks(records, len(records))
+
+# Pair each item with a flag telling whether it is the last one
+def _mark_last(items):
+    items = iter(items)
+    try:
+        previous = next(items)
+    except StopIteration:
+        return
+    for item in items:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+def _as_list(samples):
+    return samples.tolist() if isinstance(samples, np.ndarray) else list(samples)
+
+# Build the header for a new encryption. Also returns the hybrid session
+# keys (None for the ElGamal modes).
+def new_header(mode, p, g, public_key, params):
+    header = make_header(mode, p, g, public_key, params)
+    if mode == 'hybrid':
+        c1, keys = Hybrid.encapsulate(p, g, public_key)
+        Metrics.count('encrypt', modexp=2)
+        return header._replace(kem_c1=c1), keys
+    if mode == 'packed':
+        return header._replace(packing_width=Elgamal.packing_width(p, 8 * params.sampwidth)), None
+    if mode == 'additive' and params.sampwidth > 3:
+        # Every sample is recovered by a discrete-log search, too slow for 32 bits
+        raise ValueError("The additive mode supports samples of up to 24 bits.")
+    return header, None
+
+# Encrypt chunks of offset samples, yielding container chunks in order.
+# The per-sample and packed modes draw on `pool` (a Pool.EphemeralPool) when
+# given and run the remainder on the parallel engine.
+# `start_index` numbers the chunks when continuing an interrupted container.
+def encrypt_chunks(header, keys, sample_chunks, workers=None, pool=None, start_index=0):
+    for chunk in Metrics.timed('encrypt', _encrypt_chunks(header, keys, sample_chunks, workers, pool, start_index)):
+        # Two exponentiations per ciphertext (done ahead of time for pooled pairs)
+        modexp = 0 if header.mode == 'hybrid' else 2 * len(chunk.records)
+        Metrics.count('encrypt', samples=chunk.sample_count, modexp=modexp)
+        yield chunk
+
+def _encrypt_chunks(header, keys, sample_chunks, workers=None, pool=None, start_index=0):
+    sampwidth = header.params.sampwidth
+    if header.mode == 'hybrid':
+        for index, (samples, final) in enumerate(_mark_last(sample_chunks), start_index):
+            record = Hybrid.encrypt_chunk(keys, index, Audio.offset_to_bytes(samples, sampwidth), final,
+                                          associated_data(header, len(samples)))
+            yield Chunk(index, len(samples), record)
+        return
+
+    counts = deque()
+
+    def message_chunks():
+        for samples in sample_chunks:
+            samples = _as_list(samples)
+            counts.append(len(samples))
+            if header.mode == 'additive':
+                yield ExpElgamal.lift_many(header.p, header.g, samples)
+            elif header.packing_width:
+                yield Elgamal.encode_messages(header.p, Elgamal.pack_samples(samples, header.packing_width, 8 * sampwidth))
+            else:
+                yield Elgamal.encode_messages(header.p, samples)
+
+    messages = Engine.imap_encrypt(header.p, header.g, header.public_key, message_chunks(), workers, pool=pool)
+    for index, records in enumerate(messages, start_index):
+        yield Chunk(index, counts.popleft(), records)
+
+# Decrypt chunks one at a time, yielding the offset samples of each chunk.
+# When `chunks` is only part of a container, `first_index` is the position of
+# its first chunk and `last_index` that of the container's final chunk
+# (needed to verify hybrid tags).
+def decrypt_chunks(header, private_key, chunks, workers=None, last_index=None, first_index=0):
+    chunks = _in_order(chunks, first_index)
+    for messages in Metrics.timed('decrypt', _decrypt_chunks(header, private_key, chunks, workers, last_index)):
+        Metrics.count('decrypt', samples=len(messages))
+        yield messages
+
+def _decrypt_chunks(header, private_key, chunks, workers=None, last_index=None):
+    sampwidth = header.params.sampwidth
+    if header.mode == 'hybrid':
+        keys = Hybrid.decapsulate(header.p, private_key, header.kem_c1)
+        Metrics.count('decrypt', modexp=1)
+        for chunk, final in _mark_last(chunks):
+            if last_index is not None:
+                final = chunk.index == last_index
+            ciphertext, tag = chunk.records
+            data = Hybrid.decrypt_chunk(keys, chunk.index, ciphertext, tag, final,
+                                        associated_data(header, chunk.sample_count))
+            yield Audio.bytes_to_offset(data, sampwidth).tolist()
+        return
+
+    counts = deque()
+
+    def pair_chunks():
+        for chunk in chunks:
+            counts.append(chunk.sample_count)
+            Metrics.count('decrypt', modexp=len(chunk.records))
+            yield chunk.records
+
+    for messages in Engine.imap_decrypt(header.p, private_key, pair_chunks(), workers):
+        count = counts.popleft()
+        if header.mode == 'additive':
+            messages = ExpElgamal.dlog_many(header.p, header.g, messages, 1 << (8 * sampwidth))
+        else:
+            messages = Elgamal.decode_messages(header.p, messages)
+            if header.mode == 'packed':
+                messages = Elgamal.unpack_samples(messages, header.packing_width, count, 8 * sampwidth)
+            elif messages and max(messages) >> (8 * sampwidth):
+                # Wider than a sample: the ciphertext was not made for this key
+                raise ValueError("Decrypted values are out of range (wrong private key?)")
+        yield messages
+
+# Homomorphic per-window sums over an 'additive' container, computed from
+# the ciphertexts alone (no key needed). Yields (first_frame, frames, sums)
+# per window of `window_frames` frames, with one (c1, c2) pair per channel
+# encrypting the sum of that channel's offset samples in the window.
+def iter_window_sums(f, header, window_frames):
+    if header.mode != 'additive':
+        raise ValueError("Windowed sums need a container in the additive mode.")
+    nchannels = header.params.nchannels
+    window = window_frames * nchannels
+    sums = [(1, 1)] * nchannels
+    position = 0  # sample index in the audio
+    filled = 0    # samples in the current window
+    for chunk in iter_chunks(f, header):
+        pairs = chunk.records
+        finished = []
+        with Metrics.span('aggregate'):
+            offset = 0
+            while offset < len(pairs):
+                segment = pairs[offset:offset + window - filled]
+                for channel in range(nchannels):
+                    # The channel of a sample is its index modulo the channel count
+                    first = (channel - position) % nchannels
+                    sums[channel] = ExpElgamal.add(header.p, sums[channel],
+                                                   ExpElgamal.combine(header.p, segment[first::nchannels]))
+                offset += len(segment)
+                position += len(segment)
+                filled += len(segment)
+                if filled == window:
+                    finished.append(((position - filled) // nchannels, window_frames, sums))
+                    sums = [(1, 1)] * nchannels
+                    filled = 0
+        Metrics.count('aggregate', samples=len(pairs))
+        yield from finished
+    if filled:
+        yield (position - filled) // nchannels, filled // nchannels, sums
+
+# Decrypt the per-channel window sums from iter_window_sums
+def decrypt_window_sums(header, private_key, sums, frames):
+    bound = frames * ((1 << (8 * header.params.sampwidth)) - 1) + 1
+    return ExpElgamal.decrypt_many(header.p, header.g, private_key, sums, bound)
+
+# Decrypt container chunks back into offset samples
+def decrypt_samples(header, private_key, chunks, workers=None):
+    samples = []
+    for chunk_samples in decrypt_chunks(header, private_key, chunks, workers):
+        samples.extend(chunk_samples)
+    return samples
+
+# Stream-encrypt chunks of offset samples into an open container file.
+# Each chunk is written as soon as it is encrypted.
+# `progress`, when given, is called with the sample count of each written chunk.
+def encrypt_stream(f, mode, p, g, public_key, params, sample_chunks, workers=None, pool=None, progress=None):
+    header, keys = new_header(mode, p, g, public_key, params)
+    write_header(f, header)
+    for chunk in encrypt_chunks(header, keys, sample_chunks, workers, pool):
+        write_chunk(f, header, chunk)
+        if progress:
+            progress(chunk.sample_count)
+    return header
+
+# Encrypt chunks of offset samples into container bytes, yielding the
+# header and then each chunk as soon as it is encrypted
+def iter_encrypted(mode, p, g, public_key, params, sample_chunks, workers=None, pool=None):
+    header, keys = new_header(mode, p, g, public_key, params)
+    yield encode_header(header)
+    for chunk in encrypt_chunks(header, keys, sample_chunks, workers, pool):
+        yield encode_chunk(header, chunk)
+
+# Stream a WAV file into a container with bounded memory
+def encrypt_file(audio_file, container_file, mode, p, g, public_key, workers=None, pool=None,
+                 chunk_frames=Audio.CHUNK_FRAMES, progress=None):
+    params, samples = Audio.open_samples(audio_file, chunk_frames)
+    sample_chunks = (Audio.to_offset(chunk, params.sampwidth) for chunk in samples)
+    # Checkpoint files left from an earlier container at this path would be stale
+    remove_checkpoint(container_file)
+    with open(container_file, 'wb') as f:
+        return encrypt_stream(f, mode, p, g, public_key, params, sample_chunks, workers, pool, progress)
+
+# Stream a container back into a WAV file with bounded memory
+def decrypt_file(container_file, private_key, audio_file, workers=None, progress=None):
+    with open(container_file, 'rb') as f:
+        header = read_header(f)
+
+        def sample_chunks():
+            for messages in decrypt_chunks(header, private_key, iter_chunks(f, header), workers):
+                yield Audio.from_offset(messages, header.params.sampwidth)
+                if progress:
+                    progress(len(messages))
+
+        Audio.write_samples(sample_chunks(), header.params, audio_file)
+    return header
+
+# Decrypt a container from any readable file object (such as an upload
+# stream). Returns the header and a generator of decrypted WAV bytes.
+def iter_decrypted(f, private_key, workers=None):
+    header = read_header(f)
+    sample_chunks = (Audio.from_offset(messages, header.params.sampwidth)
+                     for messages in decrypt_chunks(header, private_key, iter_chunks(f, header), workers))
+    return header, Audio.iter_wav_bytes(sample_chunks, header.params)
+
+# Identify a source file so a checkpoint is only resumed against the same input
+def source_info(audio_file):
+    stat = os.stat(audio_file)
+    return {'path': os.path.abspath(audio_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+# Manifest of a checkpointed container, or None if there is none
+def load_manifest(container_file):
+    try:
+        with open(container_file + MANIFEST_SUFFIX, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def remove_checkpoint(container_file):
+    for suffix in (INDEX_SUFFIX, MANIFEST_SUFFIX):
+        if os.path.exists(container_file + suffix):
+            os.remove(container_file + suffix)
+
+# Make the chunks written so far durable, then record them in the manifest.
+# The manifest is replaced atomically and only ever names synced data.
+def _commit(container_file, f, index_file, manifest):
+    for sink in (f, index_file):
+        sink.flush()
+        os.fsync(sink.fileno())
+    manifest_file = container_file + MANIFEST_SUFFIX
+    with open(manifest_file + '.tmp', 'w') as out:
+        json.dump(manifest, out)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+# Reopen an interrupted container at its last committed chunk
+def _reopen(container_file, manifest, private_key):
+    f = open(container_file, 'r+b')
+    try:
+        header = read_header(f)
+        keys = None
+        if header.mode == 'hybrid':
+            # The session keys are not stored anywhere, so they are recovered from c1
+            if private_key is None or Backend.powmod(header.g, private_key, header.p) != header.public_key:
+                raise ValueError("Resuming a hybrid container needs the matching private key.")
+            keys = Hybrid.decapsulate(header.p, private_key, header.kem_c1)
+        f.truncate(manifest['container_bytes'])
+        f.seek(manifest['container_bytes'])
+        index_file = open(container_file + INDEX_SUFFIX, 'r+b' if os.path.exists(container_file + INDEX_SUFFIX) else 'wb')
+    except BaseException:
+        f.close()
+        raise
+    index_file.truncate(manifest['chunks'] * _INDEX.size)
+    index_file.seek(manifest['chunks'] * _INDEX.size)
+    return header, keys, f, index_file
+
+# What a checkpoint manifest must match to be resumed or reused
+def checkpoint_info(audio_file, mode, p, g, public_key, chunk_frames=Audio.CHUNK_FRAMES):
+    params = Audio.read_params(audio_file)
+    return {
+        'mode': mode, 'p': p, 'g': g, 'public_key': public_key,
+        'params': [params.nchannels, params.sampwidth, params.framerate, params.nframes],
+        'chunk_frames': chunk_frames, 'source': source_info(audio_file),
+    }
+
+# Manifest of a checkpointed container made from `checkpoint`, or None
+def matching_manifest(container_file, checkpoint):
+    manifest = load_manifest(container_file)
+    if (manifest is None or not os.path.exists(container_file)
+            or any(manifest.get(name) != value for name, value in checkpoint.items())):
+        return None
+    return manifest
+
+# Checkpointed version of encrypt_file. Every chunk is synced to disk and
+# committed to the index and manifest before the next one is written, so if
+# the process dies, calling this again with the same source, key, mode and
+# chunk size skips the committed chunks and carries on from there.
+# Hybrid containers can only be resumed with the private key.
+def encrypt_file_resumable(audio_file, container_file, mode, p, g, public_key, private_key=None,
+                           workers=None, pool=None, chunk_frames=Audio.CHUNK_FRAMES, progress=None):
+    params = Audio.read_params(audio_file)
+    checkpoint = checkpoint_info(audio_file, mode, p, g, public_key, chunk_frames)
+    manifest = matching_manifest(container_file, checkpoint)
+
+    if manifest is not None and manifest['complete']:
+        with open(container_file, 'rb') as f:
+            return read_header(f)
+    if manifest is not None:
+        header, keys, f, index_file = _reopen(container_file, manifest, private_key)
+        if progress and manifest['samples']:
+            progress(manifest['samples'])
+    else:
+        header, keys = new_header(mode, p, g, public_key, params)
+        f = open(container_file, 'w+b')
+        index_file = open(container_file + INDEX_SUFFIX, 'wb')
+        write_header(f, header)
+        manifest = dict(checkpoint, chunks=0, samples=0, container_bytes=f.tell(), complete=False)
+        _commit(container_file, f, index_file, manifest)
+
+    with f, index_file:
+        _, samples = Audio.open_samples(audio_file, chunk_frames, manifest['samples'] // params.nchannels)
+        sample_chunks = (Audio.to_offset(chunk, params.sampwidth) for chunk in samples)
+        for chunk in encrypt_chunks(header, keys, sample_chunks, workers, pool, manifest['chunks']):
+            offset = f.tell()
+            write_chunk(f, header, chunk)
+            index_file.write(_INDEX.pack(chunk.index, offset, manifest['samples'], chunk.sample_count))
+            manifest.update(chunks=chunk.index + 1, samples=manifest['samples'] + chunk.sample_count,
+                            container_bytes=f.tell())
+            _commit(container_file, f, index_file, manifest)
+            if progress:
+                progress(chunk.sample_count)
+        manifest['complete'] = True
+        _commit(container_file, f, index_file, manifest)
+    return header
+
+# Locate every chunk by reading only the chunk prefixes
+def scan_index(f, header):
+    entries = []
+    first_sample = 0
+    while True:
+        offset = f.tell()
+        prefix = _read_upto(f, _CHUNK.size)
+        if len(prefix) != _CHUNK.size:
+            return entries
+        index, sample_count, _, length = _CHUNK.unpack(prefix)
+        entries.append(IndexEntry(index, offset, first_sample, sample_count))
+        first_sample += sample_count
+        f.seek(length, os.SEEK_CUR)
+
+# Chunk index of a container file: the sidecar index when it matches the
+# container, otherwise a scan of the open file (positioned after the header)
+def read_index(container_file, f, header):
+    manifest = load_manifest(container_file)
+    index_file = container_file + INDEX_SUFFIX
+    if (manifest is not None and os.path.exists(index_file)
+            and manifest['container_bytes'] == os.path.getsize(container_file)
+            and os.path.getsize(index_file) == manifest['chunks'] * _INDEX.size):
+        with open(index_file, 'rb') as index:
+            return [IndexEntry(*entry) for entry in _INDEX.iter_unpack(index.read())]
+    return scan_index(f, header)
+
+# Frame range for a time range in seconds (end None = end of the audio)
+def frame_range(params, start_seconds=0, end_seconds=None):
+    if not all(math.isfinite(seconds) for seconds in (start_seconds, end_seconds) if seconds is not None):
+        raise ValueError("The range must be given as finite times in seconds.")
+    start = max(0, min(round(start_seconds * params.framerate), params.nframes))
+    end = params.nframes if end_seconds is None else min(round(end_seconds * params.framerate), params.nframes)
+    if end < start:
+        raise ValueError("The end of the range comes before its start.")
+    return start, end
+
+# Decrypt frames [start_frame, end_frame) of a container file, reading and
+# decrypting only the chunks that cover them. Returns the WAV parameters of
+# the excerpt and a generator of integer sample chunks.
+def open_range(container_file, private_key, start_frame=0, end_frame=None, workers=None):
+    f = open(container_file, 'rb')
+    try:
+        header = read_header(f)
+        entries = read_index(container_file, f, header)
+    except BaseException:
+        f.close()
+        raise
+    params = header.params
+    nchannels = params.nchannels
+    end_frame = params.nframes if end_frame is None else min(end_frame, params.nframes)
+    start, end = start_frame * nchannels, end_frame * nchannels
+    covered = entries[-1].first_sample + entries[-1].sample_count if entries else 0
+    if end > covered:
+        f.close()
+        raise ValueError("The container does not cover the requested range (is its encryption finished?)")
+    # Chunks are checked against their position in the index. The last one
+    # is final only if the container holds every sample.
+    last_index = len(entries) - 1 if covered == params.nframes * nchannels else -1
+    first = max(bisect.bisect_right([entry.first_sample for entry in entries], start) - 1, 0)
+    selected = [entry for entry in entries[first:] if entry.first_sample < end]
+
+    def chunks():
+        for entry in selected:
+            f.seek(entry.offset)
+            yield read_chunk(f, header)
+
+    def sample_chunks():
+        with f:
+            position = selected[0].first_sample if selected else start
+            for messages in decrypt_chunks(header, private_key, chunks(), workers, last_index, first):
+                low, high = max(start - position, 0), min(end - position, len(messages))
+                position += len(messages)
+                yield Audio.from_offset(messages[low:high], params.sampwidth)
+
+    return params._replace(nframes=end_frame - start_frame), sample_chunks()
+
+# Decrypt a time range of a container file into a WAV file
+def decrypt_range(container_file, private_key, audio_file, start_seconds=0, end_seconds=None, workers=None):
+    with open(container_file, 'rb') as f:
+        params = read_header(f).params
+    start_frame, end_frame = frame_range(params, start_seconds, end_seconds)
+    params, sample_chunks = open_range(container_file, private_key, start_frame, end_frame, workers)
+    Audio.write_samples(sample_chunks, params, audio_file)
+    return params
+
+# Re-encryption key that moves ciphertexts from the key pair with private
+# key `old_private_key` to the one with `new_private_key` (same p and g):
+# c2 * c1^(b - a) turns m * g^(ak) into m * g^(bk). Making it needs both
+# private keys. A proxy holding only it can re-key containers without
+# decrypting them, but it is not collusion-safe: it and either private key
+# give the other, so the proxy must not collude with the new key's holder.
+def reencryption_key(p, old_private_key, new_private_key):
+    return (new_private_key - old_private_key) % (p - 1)
+
+# Re-encrypt container chunks without decrypting them. With no `public_key`
+# every ciphertext is re-randomized under the container's own key (same
+# samples, fresh randomness); with a `public_key` and the matching
+# `reencryption_key` the ciphertexts are moved to that key in the same
+# pass. Hybrid containers are re-keyed by re-encapsulating the session key,
+# which needs the container's private key instead of a re-encryption key.
+# Returns the new header and a generator of the new chunks.
+def reencrypt_chunks(header, chunks, public_key=None, reencryption_key=0, private_key=None,
+                     workers=None, pool=None):
+    p, g = header.p, header.g
+    target = header.public_key if public_key is None else public_key
+    keys = None
+    if header.mode == 'hybrid':
+        if private_key is None or Backend.powmod(g, private_key, p) != header.public_key:
+            raise ValueError("Re-keying a hybrid container needs its private key.")
+        # A fresh session key, also when re-randomizing under the same key
+        kem_c1, new_keys = Hybrid.encapsulate(p, g, target)
+        keys = Hybrid.decapsulate(p, private_key, header.kem_c1), new_keys
+        Metrics.count('reencrypt', modexp=3)
+        new_header = header._replace(public_key=target, kem_c1=kem_c1)
+    else:
+        if public_key is None:
+            reencryption_key = 0
+        elif header.public_key * Backend.powmod(g, reencryption_key, p) % p != public_key:
+            raise ValueError("The re-encryption key does not lead to the target public key.")
+        new_header = header._replace(public_key=target)
+
+    def counted():
+        chunks_out = _reencrypt_chunks(new_header, keys, chunks, reencryption_key, workers, pool)
+        for chunk in Metrics.timed('reencrypt', chunks_out):
+            # Two exponentiations per pair, plus c1^rk when moving to another key
+            modexp = 0 if keys else (3 if reencryption_key else 2) * len(chunk.records)
+            Metrics.count('reencrypt', samples=chunk.sample_count, modexp=modexp)
+            yield chunk
+
+    return new_header, counted()
+
+def _reencrypt_chunks(header, keys, chunks, reencryption_key, workers=None, pool=None):
+    chunks = _in_order(chunks)
+    if keys is not None:
+        old_keys, new_keys = keys
+        for chunk, final in _mark_last(chunks):
+            ciphertext, tag = chunk.records
+            records = Hybrid.rekey_chunk(old_keys, new_keys, chunk.index, ciphertext, tag, final,
+                                         associated_data(header, chunk.sample_count))
+            yield chunk._replace(records=records)
+        return
+
+    pending = deque()
+
+    def pair_chunks():
+        for chunk in chunks:
+            pending.append((chunk.index, chunk.sample_count))
+            yield chunk.records
+
+    for records in Engine.imap_rerandomize(header.p, header.g, header.public_key, pair_chunks(),
+                                           reencryption_key, workers, pool=pool):
+        index, sample_count = pending.popleft()
+        yield Chunk(index, sample_count, records)
+
+# Re-encrypt a container file chunk by chunk (see reencrypt_chunks). The
+# output is written next to its destination and moved into place once
+# complete, so `output_file` may be the input itself (the default).
+def reencrypt_file(container_file, output_file=None, public_key=None, reencryption_key=0, private_key=None,
+                   workers=None, pool=None, progress=None):
+    output_file = output_file or container_file
+    manifest = load_manifest(container_file)
+    if manifest is not None and not manifest['complete']:
+        raise ValueError("The container's encryption is not finished.")
+    temporary = output_file + '.tmp'
+    try:
+        with open(container_file, 'rb') as f, open(temporary, 'wb') as out:
+            header = read_header(f)
+            header, chunks = reencrypt_chunks(header, iter_chunks(f, header), public_key, reencryption_key,
+                                              private_key, workers, pool)
+            write_header(out, header)
+            for chunk in chunks:
+                write_chunk(out, header, chunk)
+                if progress:
+                    progress(chunk.sample_count)
+            out.flush()
+            os.fsync(out.fileno())
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    # The chunk offsets in an old index may not hold for the new header
+    remove_checkpoint(output_file)
+    os.replace(temporary, output_file)
+    return header
+
+# Re-encrypt a container from any readable file object (such as an upload
+# stream), yielding the new header and then each chunk as soon as it is ready
+def iter_reencrypted(f, public_key=None, reencryption_key=0, private_key=None, workers=None, pool=None):
+    header = read_header(f)
+    header, chunks = reencrypt_chunks(header, iter_chunks(f, header), public_key, reencryption_key,
+                                      private_key, workers, pool)
+    yield encode_header(header)
+    for chunk in chunks:
+        yield encode_chunk(header, chunk)
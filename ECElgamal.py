@@ -0,0 +1,323 @@
+import random
+import secrets
+from collections import namedtuple
+from functools import lru_cache
+import Backend
+import Elgamal
+import Metrics
+
+# Elliptic-curve ElGamal over NIST P-256 with the same keygen/encrypt/decrypt
+# API as Elgamal.py. Messages are integers mapped onto curve points
+# (Koblitz encoding), so packed audio blocks work as in the multiplicative
+# group; a ciphertext is two compressed points (66 bytes) instead of two
+# 3072-bit integers (768 bytes) at a comparable security level. Points are
+# affine (x, y) tuples with None as the point at infinity; the arithmetic is
+# pure Python in Jacobian coordinates, with inversions and square roots
+# through the Backend (gmpy2 when available).
+
+Curve = namedtuple('Curve', 'name p a b n g')
+
+P256 = Curve(
+    'P-256',
+    0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+    0xffffffff00000001000000000000000000000000fffffffffffffffffffffffc,
+    0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+    0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551,
+    (0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+     0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5),
+)
+
+# Low bits of x reserved for the message-to-point search (256 candidates)
+ENCODING_BITS = 8
+WINDOW = 4
+
+_rng = random.SystemRandom()
+_INFINITY = (1, 1, 0)
+
+def is_on_curve(curve, point):
+    if point is None:
+        return True
+    x, y = point
+    return (y * y - x * x * x - curve.a * x - curve.b) % curve.p == 0
+
+def _to_jacobian(point):
+    return _INFINITY if point is None else (point[0], point[1], 1)
+
+def _to_affine(curve, point):
+    x, y, z = point
+    if not z:
+        return None
+    p = curve.p
+    z_inv = Backend.invert(z, p)
+    z_inv2 = z_inv * z_inv % p
+    return x * z_inv2 % p, y * z_inv2 * z_inv % p
+
+# Convert many Jacobian points to affine with a single inversion
+def _to_affine_many(curve, points):
+    p = curve.p
+    finite = [i for i, point in enumerate(points) if point[2]]
+    inverses = Elgamal.batch_inverse([points[i][2] for i in finite], p)
+    affine = [None] * len(points)
+    for i, z_inv in zip(finite, inverses):
+        x, y, _ = points[i]
+        z_inv2 = z_inv * z_inv % p
+        affine[i] = x * z_inv2 % p, y * z_inv2 * z_inv % p
+    return affine
+
+def _double(curve, point):
+    x, y, z = point
+    if not z or not y:
+        return _INFINITY
+    p = curve.p
+    yy = y * y % p
+    s = 4 * x * yy % p
+    zz = z * z % p
+    m = (3 * x * x + curve.a * zz * zz) % p
+    x3 = (m * m - 2 * s) % p
+    return x3, (m * (s - x3) - 8 * yy * yy) % p, 2 * y * z % p
+
+def _add(curve, first, second):
+    x1, y1, z1 = first
+    x2, y2, z2 = second
+    if not z1:
+        return second
+    if not z2:
+        return first
+    p = curve.p
+    z1z1 = z1 * z1 % p
+    z2z2 = z2 * z2 % p
+    u1 = x1 * z2z2 % p
+    u2 = x2 * z1z1 % p
+    s1 = y1 * z2 * z2z2 % p
+    s2 = y2 * z1 * z1z1 % p
+    h = (u2 - u1) % p
+    r = (s2 - s1) % p
+    if not h:
+        return _double(curve, first) if not r else _INFINITY
+    hh = h * h % p
+    hhh = h * hh % p
+    v = u1 * hh % p
+    x3 = (r * r - hhh - 2 * v) % p
+    return x3, (r * (v - x3) - s1 * hhh) % p, h * z1 * z2 % p
+
+# Mixed addition of a Jacobian point and an affine point
+def _add_affine(curve, first, second):
+    x1, y1, z1 = first
+    x2, y2 = second
+    if not z1:
+        return x2, y2, 1
+    p = curve.p
+    z1z1 = z1 * z1 % p
+    h = (x2 * z1z1 - x1) % p
+    r = (y2 * z1 * z1z1 - y1) % p
+    if not h:
+        return _double(curve, first) if not r else _INFINITY
+    hh = h * h % p
+    hhh = h * hh % p
+    v = x1 * hh % p
+    x3 = (r * r - hhh - 2 * v) % p
+    return x3, (r * (v - x3) - y1 * hhh) % p, h * z1 % p
+
+def point_add(curve, first, second):
+    return _to_affine(curve, _add(curve, _to_jacobian(first), _to_jacobian(second)))
+
+def point_neg(curve, point):
+    return None if point is None else (point[0], -point[1] % curve.p)
+
+# Scalar multiplication k * point with a fixed 4-bit window
+def scalar_mult(curve, k, point):
+    k %= curve.n
+    if not k or point is None:
+        return None
+    table = [_INFINITY, _to_jacobian(point)]
+    for _ in range(2, 1 << WINDOW):
+        table.append(_add(curve, table[-1], table[1]))
+    result = _INFINITY
+    for shift in range((k.bit_length() + WINDOW - 1) // WINDOW * WINDOW - WINDOW, -1, -WINDOW):
+        for _ in range(WINDOW):
+            result = _double(curve, result)
+        digit = (k >> shift) & ((1 << WINDOW) - 1)
+        if digit:
+            result = _add(curve, result, table[digit])
+    return _to_affine(curve, result)
+
+# Fixed-base table for a point: row i holds d * 2^(window*i) * point in affine
+# form for every window digit d, so k * point costs one mixed addition per
+# window of k and no doublings.
+class FixedBaseTable:
+    def __init__(self, curve, point, window=8):
+        self.curve = curve
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.rows = []
+        base = _to_jacobian(point)
+        for _ in range((curve.n.bit_length() + window - 1) // window):
+            row = [_INFINITY, base]
+            for _ in range(2, 1 << window):
+                row.append(_add(curve, row[-1], base))
+            self.rows.append(row)
+            base = _add(curve, row[-1], base)
+        # Normalise every entry to affine form with one inversion
+        entries = _to_affine_many(curve, [entry for row in self.rows for entry in row])
+        size = 1 << window
+        self.rows = [entries[i:i + size] for i in range(0, len(entries), size)]
+
+    def mult(self, k):
+        curve, window, mask = self.curve, self.window, self.mask
+        result = _INFINITY
+        for row in self.rows:
+            if not k:
+                break
+            digit = k & mask
+            if digit:
+                result = _add_affine(curve, result, row[digit])
+            k >>= window
+        return _to_affine(curve, result)
+
+@lru_cache(maxsize=4)
+def base_table(curve):
+    return FixedBaseTable(curve, curve.g)
+
+# Point with the given x coordinate (even y), or None if x is not on the curve
+def lift_x(curve, x):
+    p = curve.p
+    rhs = (x * x * x + curve.a * x + curve.b) % p
+    # p = 3 (mod 4) for P-256, so a square root is rhs^((p + 1) / 4)
+    y = Backend.powmod(rhs, (p + 1) // 4, p)
+    if y * y % p != rhs:
+        return None
+    return x, y if y % 2 == 0 else p - y
+
+# Number of message bits that fit into one point
+def message_bits(curve):
+    return curve.p.bit_length() - ENCODING_BITS - 1
+
+# Koblitz encoding: x = message * 2^ENCODING_BITS + j for the first j that
+# lands on the curve (each try succeeds with probability about 1/2)
+def encode_message(curve, message):
+    if not 0 <= message < 1 << message_bits(curve):
+        raise ValueError(f"Message does not fit into a {curve.name} point")
+    for j in range(1 << ENCODING_BITS):
+        point = lift_x(curve, (message << ENCODING_BITS) | j)
+        if point is not None:
+            return point
+    raise ValueError(f"Could not encode message {message} as a {curve.name} point")
+
+def decode_message(curve, point):
+    return point[0] >> ENCODING_BITS
+
+# SEC1 compressed point encoding (33 bytes for P-256)
+def encode_point(curve, point):
+    size = (curve.p.bit_length() + 7) // 8
+    if point is None:
+        return bytes(size + 1)
+    x, y = point
+    return bytes([2 + (y & 1)]) + x.to_bytes(size, 'big')
+
+def decode_point(curve, data):
+    size = (curve.p.bit_length() + 7) // 8
+    if len(data) != size + 1 or data[0] not in (0, 2, 3):
+        raise ValueError("Invalid compressed point encoding")
+    if data[0] == 0:
+        return None
+    x = int.from_bytes(data[1:], 'big')
+    point = lift_x(curve, x) if x < curve.p else None
+    if point is None:
+        raise ValueError("Compressed point is not on the curve")
+    return point if point[1] & 1 == data[0] - 2 else point_neg(curve, point)
+
+# Serialize (c1, c2) pairs as concatenated compressed points
+def encode_pairs(curve, pairs):
+    return b''.join(encode_point(curve, point) for pair in pairs for point in pair)
+
+def decode_pairs(curve, data):
+    size = (curve.p.bit_length() + 7) // 8 + 1
+    if len(data) % (2 * size):
+        raise ValueError("Truncated EC ciphertext data")
+    points = [decode_point(curve, data[i:i + size]) for i in range(0, len(data), size)]
+    return list(zip(points[0::2], points[1::2]))
+
+# EC-ElGamal key generation: returns (private_key, public_key, curve, g) in
+# the order of Elgamal.elgamal_keygen
+def elgamal_keygen(curve=P256):
+    with Metrics.span('keygen'):
+        private_key = secrets.randbelow(curve.n - 1) + 1
+        public_key = base_table(curve).mult(private_key)
+    return private_key, public_key, curve, curve.g
+
+# EC-ElGamal public key with fixed-base tables for k*G and k*Y
+class ECPublicKey:
+    def __init__(self, curve, public_key):
+        if public_key is None or not is_on_curve(curve, public_key):
+            raise ValueError("Public key is not a point on the curve")
+        self.curve = curve
+        self.public_key = public_key
+        self.g_table = base_table(curve)
+        self.y_table = FixedBaseTable(curve, public_key)
+
+    def encrypt(self, message, rng=_rng):
+        return self.encrypt_point(encode_message(self.curve, message), rng)
+
+    def encrypt_point(self, point, rng=_rng):
+        k = rng.randint(1, self.curve.n - 1)
+        shared = _to_jacobian(self.y_table.mult(k))
+        c2 = _to_affine(self.curve, _add(self.curve, shared, _to_jacobian(point)))
+        return self.g_table.mult(k), c2
+
+    def encrypt_many(self, messages, rng=_rng):
+        return [self.encrypt(message, rng) for message in messages]
+
+@lru_cache(maxsize=16)
+def get_public_key(curve, public_key):
+    return ECPublicKey(curve, public_key)
+
+# EC-ElGamal encryption of an integer message: (k*G, M + k*Y)
+def elgamal_encrypt(curve, g, public_key, message):
+    if g != curve.g:
+        raise ValueError("Only the curve's standard base point is supported")
+    return get_public_key(curve, public_key).encrypt(message)
+
+# EC-ElGamal decryption: M = c2 - x*c1, decoded back into the integer message
+def elgamal_decrypt(curve, private_key, c1, c2):
+    shared = scalar_mult(curve, private_key, c1)
+    return decode_message(curve, point_add(curve, c2, point_neg(curve, shared)))
+
+def elgamal_decrypt_many(curve, private_key, pairs):
+    return [elgamal_decrypt(curve, private_key, c1, c2) for c1, c2 in pairs]
+
+# Number of samples per point (one bit is kept for Elgamal.pack_samples' guard bit)
+def packing_width(curve, sample_bits=Elgamal.SAMPLE_BITS):
+    width = (message_bits(curve) - 1) // sample_bits
+    if width < 1:
+        raise ValueError(f"{curve.name} points are too small to hold a {sample_bits}-bit sample")
+    return width
+
+# Packed EC-ElGamal encryption: returns the packing header and the ciphertext pairs
+def elgamal_encrypt_packed(curve, g, public_key, samples, sample_bits=Elgamal.SAMPLE_BITS):
+    if g != curve.g:
+        raise ValueError("Only the curve's standard base point is supported")
+    width = packing_width(curve, sample_bits)
+    blocks = Elgamal.pack_samples(samples, width, sample_bits)
+    return width, len(samples), get_public_key(curve, public_key).encrypt_many(blocks)
+
+def elgamal_decrypt_packed(curve, private_key, encrypted_data, width, count, sample_bits=Elgamal.SAMPLE_BITS):
+    blocks = elgamal_decrypt_many(curve, private_key, encrypted_data)
+    return Elgamal.unpack_samples(blocks, width, count, sample_bits)
+
+if __name__ == '__main__':
+    private_key, public_key, curve, g = elgamal_keygen()
+    print(f"Curve: {curve.name}")
+    print(f"Public Key: {encode_point(curve, public_key).hex()}")
+    print(f"Private Key: {private_key}")
+
+    message = 1234567890
+    c1, c2 = elgamal_encrypt(curve, g, public_key, message)
+    print(f"Encrypted message: {encode_pairs(curve, [(c1, c2)]).hex()}")
+    print(f"Decrypted message: {elgamal_decrypt(curve, private_key, c1, c2)}")
+
+    samples = [0, 1, 32768, 65535, 12345, 54321, 7, 8, 9] * 4
+    width, count, packed = elgamal_encrypt_packed(curve, g, public_key, samples)
+    data = encode_pairs(curve, packed)
+    print(f"Packed {count} samples into {len(packed)} ciphertexts ({width} per block, {len(data)} bytes)")
+    unpacked = elgamal_decrypt_packed(curve, private_key, decode_pairs(curve, data), width, count)
+    print(f"Round trip ok: {unpacked == samples}")
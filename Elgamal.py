@@ -1,39 +1,230 @@
 import random
-from sympy import randprime, mod_inverse
+import secrets
+from functools import lru_cache
+import Backend
+import Metrics
+import Params
 
-# Function to generate large prime using sympy
+# Ephemeral exponents come from the OS CSPRNG: a predictable k exposes the
+# message to anyone holding the public key
+_rng = random.SystemRandom()
+
+# Function to generate large prime using sympy (imported here, as it is
+# slow to load and only needed for these helpers)
 def find_large_prime(bit_length=128):
+    from sympy import randprime
     return randprime(2**(bit_length-1), 2**bit_length)
 
-# Function to find a generator for prime p
-def find_generator(p):
-    for g in range(2, p):
-        if pow(g, 2, p) != 1 and pow(g, (p - 1) // 2, p) != 1:
-            return g
-    raise ValueError(f"No generator found for prime {p}")
+# Function to find a generator for prime p, proven from the prime factors
+# of p - 1 (factored with sympy when not supplied)
+def find_generator(p, factors=None):
+    if factors is None:
+        from sympy import primefactors
+        factors = primefactors(p - 1)
+    return Params.find_generator(p, factors)
+
+# Private key in [1, p - 2], the exponent range of a generator of Z_p^*
+def random_private_key(p):
+    return secrets.randbelow(p - 2) + 1
 
-# ElGamal key generation
+# ElGamal key generation: (p, g) come from the cached group parameters,
+# so only the key pair itself is generated per call
 def elgamal_keygen(bit_length=128):
-    p = find_large_prime(bit_length)
-    g = find_generator(p)
-    private_key = random.randint(1, p - 2)
-    public_key = pow(g, private_key, p)
-    return private_key, public_key, p, g
+    with Metrics.span('keygen'):
+        group = Params.get_group(bit_length)
+        private_key = random_private_key(group.p)
+        public_key = Backend.powmod(group.g, private_key, group.p)
+    Metrics.count('keygen', modexp=1)
+    return private_key, public_key, group.p, group.g
 
 # ElGamal encryption
 def elgamal_encrypt(p, g, public_key, message):
-    k = random.randint(1, p - 2)
-    c1 = pow(g, k, p)
-    c2 = (message * pow(public_key, k, p)) % p
+    k = _rng.randint(1, p - 2)
+    c1 = Backend.powmod(g, k, p)
+    c2 = (message * Backend.powmod(public_key, k, p)) % p
     return c1, c2
 
 # ElGamal decryption
 def elgamal_decrypt(p, private_key, c1, c2):
-    s = pow(c1, private_key, p)
-    s_inv = mod_inverse(s, p)
+    s = Backend.powmod(c1, private_key, p)
+    s_inv = Backend.invert(s, p)
     m = (c2 * s_inv) % p
     return m
 
+# Montgomery batch inversion: inverts every value mod p with a single
+# modular inversion and 3(n-1) multiplications
+def batch_inverse(values, p):
+    if not values:
+        return []
+    prefix = [values[0]]
+    for value in values[1:]:
+        prefix.append(prefix[-1] * value % p)
+    inverse = Backend.invert(prefix[-1], p)
+    inverses = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        inverses[i] = inverse * prefix[i - 1] % p
+        inverse = inverse * values[i] % p
+    inverses[0] = inverse
+    return inverses
+
+# ElGamal decryption of many (c1, c2) pairs.
+# 'exponent' computes s^-1 = c1^(p-1-x) directly, so no inversion is needed;
+# 'batch' computes s = c1^x and inverts all of them with batch_inverse.
+def elgamal_decrypt_many(p, private_key, pairs, method='exponent'):
+    if method == 'exponent':
+        exponent = p - 1 - private_key
+        powmod = Backend.powmod
+        return [(c2 * powmod(c1, exponent, p)) % p for c1, c2 in pairs]
+    if method == 'batch':
+        powmod = Backend.powmod
+        inverses = batch_inverse([powmod(c1, private_key, p) for c1, _ in pairs], p)
+        return [(c2 * s_inv) % p for (_, c2), s_inv in zip(pairs, inverses)]
+    raise ValueError(f"Unknown decryption method: {method}")
+
+# Order of the quadratic residues mod p, which messages are encoded into.
+# Only a safe prime p = 2q + 1 makes that group of prime order, so other
+# primes (such as Schnorr groups) are refused for direct message encryption.
+@lru_cache(maxsize=16)
+def message_order(p):
+    q = (p - 1) // 2
+    if not Params.is_probable_prime(q, 8):
+        raise ValueError("Encrypting samples directly needs a safe-prime group (p = 2q + 1); "
+                         "use the hybrid or additive mode with this key.")
+    return q
+
+# Encode messages in [0, q) as quadratic residues: m or p - m, whichever is
+# a residue (-1 is not one for a safe prime), with q standing in for 0.
+# The ciphertexts then reveal nothing about the messages through their
+# residuosity.
+def encode_messages(p, messages):
+    q = message_order(p)
+    if messages and max(messages) >= q:
+        raise ValueError(f"Messages must be below {q}")
+    jacobi = Backend.jacobi
+    encoded = []
+    for message in messages:
+        value = message or q
+        encoded.append(value if jacobi(value, p) == 1 else p - value)
+    return encoded
+
+# Inverse of encode_messages
+def decode_messages(p, values):
+    q = (p - 1) // 2
+    decoded = []
+    for value in values:
+        if value > q:
+            value = p - value
+        decoded.append(0 if value == q else value)
+    return decoded
+
+# Default bits per offset sample when packing (16-bit PCM shifted to 0-65535)
+SAMPLE_BITS = 16
+
+# Number of samples that fit into one plaintext below q = (p - 1) / 2, the
+# bound of encode_messages (one bit is reserved for the guard bit that keeps
+# the plaintext non-zero)
+def packing_width(p, sample_bits=SAMPLE_BITS):
+    width = (p.bit_length() - 3) // sample_bits
+    if width < 1:
+        raise ValueError(f"Prime {p} is too small to hold a {sample_bits}-bit sample")
+    return width
+
+# Pack offset samples into plaintext integers, `width` samples per block
+def pack_samples(samples, width, sample_bits=SAMPLE_BITS):
+    blocks = []
+    for start in range(0, len(samples), width):
+        block = 1  # guard bit
+        for sample in samples[start:start + width]:
+            block = (block << sample_bits) | sample
+        blocks.append(block)
+    return blocks
+
+# Unpack plaintext blocks back into `count` offset samples. A block
+# decrypted with the wrong key is a random value whose top bits are almost
+# never exactly the guard bit, so that is reported as an error.
+def unpack_samples(blocks, width, count, sample_bits=SAMPLE_BITS):
+    mask = (1 << sample_bits) - 1
+    samples = []
+    for index, block in enumerate(blocks):
+        n = min(width, count - index * width)
+        if block >> (n * sample_bits) != 1:
+            raise ValueError("Decrypted block lacks its guard bit (wrong private key?)")
+        for shift in range((n - 1) * sample_bits, -1, -sample_bits):
+            samples.append((block >> shift) & mask)
+    return samples
+
+# Packed ElGamal encryption: returns the packing header and the ciphertext pairs
+def elgamal_encrypt_packed(p, g, public_key, samples, sample_bits=SAMPLE_BITS):
+    width = packing_width(p, sample_bits)
+    blocks = encode_messages(p, pack_samples(samples, width, sample_bits))
+    encrypted_data = get_public_key(p, g, public_key).encrypt_many(blocks)
+    return width, len(samples), encrypted_data
+
+# Packed ElGamal decryption using the recorded packing width and sample count
+def elgamal_decrypt_packed(p, private_key, encrypted_data, width, count, sample_bits=SAMPLE_BITS):
+    blocks = decode_messages(p, elgamal_decrypt_many(p, private_key, encrypted_data))
+    return unpack_samples(blocks, width, count, sample_bits)
+
+# Fixed-base windowed exponentiation table: row i holds base^(d * 2^(window*i))
+# for every window digit d, so base^k costs one multiplication per window
+# of k and no squarings. Entries are held as backend integers (gmpy2.mpz
+# when available) so the multiplications run in the backend.
+class FixedBaseTable:
+    def __init__(self, base, p, exponent_bits, window):
+        mpz = Backend.mpz
+        self.p = p = mpz(p)
+        base = mpz(base)
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.rows = []
+        for _ in range((exponent_bits + window - 1) // window):
+            row = [mpz(1), base]
+            for _ in range(2, 1 << window):
+                row.append(row[-1] * base % p)
+            self.rows.append(row)
+            base = row[-1] * base % p
+
+    def pow(self, k):
+        p, window, mask = self.p, self.window, self.mask
+        result = 1
+        for row in self.rows:
+            if not k:
+                break
+            digit = k & mask
+            if digit:
+                result = result * row[digit] % p
+            k >>= window
+        return int(result)
+
+# ElGamal public key with precomputed fixed-base tables for g^k and y^k
+class ElGamalPublicKey:
+    def __init__(self, p, g, public_key, window=None):
+        self.p = p
+        self.g = g
+        self.public_key = public_key
+        bits = p.bit_length()
+        if window is None:
+            window = 8 if bits <= 256 else 6
+        self.g_table = FixedBaseTable(g, p, bits, window)
+        self.y_table = FixedBaseTable(public_key, p, bits, window)
+
+    def encrypt(self, message, rng=_rng):
+        k = rng.randint(1, self.p - 2)
+        return self.g_table.pow(k), (message * self.y_table.pow(k)) % self.p
+
+    def encrypt_many(self, messages, rng=_rng):
+        p, g_pow, y_pow = self.p, self.g_table.pow, self.y_table.pow
+        encrypted_data = []
+        for message in messages:
+            k = rng.randint(1, p - 2)
+            encrypted_data.append((g_pow(k), (message * y_pow(k)) % p))
+        return encrypted_data
+
+# Cached ElGamalPublicKey so the tables are built once per key
+@lru_cache(maxsize=16)
+def get_public_key(p, g, public_key):
+    return ElGamalPublicKey(p, g, public_key)
+
 if __name__ == '__main__':
     private_key, public_key, p, g = elgamal_keygen(128)
     print(f"Public Key: {public_key}")
@@ -47,3 +238,8 @@ if __name__ == '__main__':
 
     decrypted_message = elgamal_decrypt(p, private_key, c1, c2)
     print(f"Decrypted message: {decrypted_message}")
+
+    samples = [0, 1, 32768, 65535, 12345, 54321, 7, 8, 9]
+    width, count, packed = elgamal_encrypt_packed(p, g, public_key, samples)
+    print(f"Packed {count} samples into {len(packed)} ciphertexts ({width} per block)")
+    print(f"Unpacked samples: {elgamal_decrypt_packed(p, private_key, packed, width, count)}")
@@ -0,0 +1,151 @@
+import os
+import random
+import threading
+from collections import deque
+import Backend
+import Elgamal
+import Lazy
+
+# Parallel encrypt/decrypt engine for per-sample (and packed) ElGamal.
+# Work is split into fixed-size chunks that run on a shared process pool;
+# results are returned in input order.
+
+# The process pool machinery is only loaded once an executor is needed
+futures = Lazy.Module('concurrent.futures')
+
+WORKERS = int(os.environ.get('ELGAMAL_WORKERS', os.cpu_count() or 1))
+CHUNK_SIZE = int(os.environ.get('ELGAMAL_CHUNK_SIZE', 4096))
+MAX_PENDING = int(os.environ.get('ELGAMAL_MAX_PENDING', 2 * WORKERS))
+
+_executors = {}
+_executors_lock = threading.Lock()
+_rng = None
+
+# Give each worker process its own OS-backed random number generator and
+# the parent's arithmetic backend
+def _init_worker(backend=None):
+    global _rng
+    _rng = random.SystemRandom()
+    if backend:
+        Backend.set_backend(backend)
+
+def _encrypt_chunk(args):
+    p, g, public_key, messages = args
+    # Fixed-base tables are built once per key in each worker and then reused
+    key = Elgamal.get_public_key(p, g, public_key)
+    return key.encrypt_many(messages, _rng or random.SystemRandom())
+
+def _decrypt_chunk(args):
+    p, private_key, pairs = args
+    return Elgamal.elgamal_decrypt_many(p, private_key, pairs)
+
+# Re-randomize (c1, c2) pairs under `public_key`, first multiplying c2 by
+# c1^exponent when an exponent (a re-encryption key) is given
+def _rerandomize_chunk(args):
+    p, g, public_key, exponent, pairs = args
+    key = Elgamal.get_public_key(p, g, public_key)
+    g_pow, y_pow = key.g_table.pow, key.y_table.pow
+    powmod = Backend.powmod
+    rng = _rng or random.SystemRandom()
+    output = []
+    for c1, c2 in pairs:
+        if exponent:
+            c2 = c2 * powmod(c1, exponent, p) % p
+        r = rng.randint(1, p - 2)
+        output.append((c1 * g_pow(r) % p, c2 * y_pow(r) % p))
+    return output
+
+# Return the shared process pool for the given worker count (one pool per
+# arithmetic backend, so a runtime backend override reaches the workers)
+def get_executor(workers=None):
+    workers = workers or WORKERS
+    key = (workers, Backend.name)
+    with _executors_lock:
+        if key not in _executors:
+            _executors[key] = futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                  initargs=(Backend.name,))
+        return _executors[key]
+
+def shutdown():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
+
+def _run(function, make_args, items, workers, chunk_size):
+    workers = workers or WORKERS
+    chunk_size = chunk_size or CHUNK_SIZE
+    tasks = [make_args(items[start:start + chunk_size]) for start in range(0, len(items), chunk_size)]
+    # Small jobs or a single worker are not worth the inter-process overhead
+    if workers <= 1 or len(tasks) <= 1:
+        results = map(function, tasks)
+    else:
+        results = get_executor(workers).map(function, tasks)
+    output = []
+    for result in results:
+        output.extend(result)
+    return output
+
+# Encrypt each message in parallel, preserving order
+def parallel_encrypt(p, g, public_key, messages, workers=None, chunk_size=None):
+    return _run(_encrypt_chunk, lambda chunk: (p, g, public_key, chunk), messages, workers, chunk_size)
+
+# Decrypt each (c1, c2) pair in parallel, preserving order
+def parallel_decrypt(p, private_key, pairs, workers=None, chunk_size=None):
+    return _run(_decrypt_chunk, lambda chunk: (p, private_key, chunk), pairs, workers, chunk_size)
+
+# Ordered streaming map with backpressure: at most `max_pending` chunks are
+# in flight, so memory stays bounded however long the input is
+def _imap(function, make_args, chunks, workers, max_pending, prepare=None):
+    workers = workers or WORKERS
+    max_pending = max_pending or MAX_PENDING
+    executor = get_executor(workers) if workers > 1 else None
+    pending = deque()
+
+    def submit(items):
+        head, rest = prepare(items) if prepare else ([], items)
+        if not rest:
+            return head, None
+        if executor is None:
+            return head + function(make_args(rest)), None
+        return head, executor.submit(function, make_args(rest))
+
+    def collect(entry):
+        head, future = entry
+        return head + future.result() if future else head
+
+    for items in chunks:
+        pending.append(submit(list(items)))
+        if len(pending) >= max_pending:
+            yield collect(pending.popleft())
+    while pending:
+        yield collect(pending.popleft())
+
+# Stream-encrypt chunks of messages, yielding one list of pairs per chunk.
+# Pairs from `pool` (a Pool.EphemeralPool) are used first when given.
+def imap_encrypt(p, g, public_key, message_chunks, workers=None, max_pending=None, pool=None):
+    def prepare(messages):
+        pairs = pool.take_many(len(messages))
+        head = [(c1, (message * s) % p) for (c1, s), message in zip(pairs, messages)]
+        return head, messages[len(pairs):]
+
+    return _imap(_encrypt_chunk, lambda chunk: (p, g, public_key, chunk), message_chunks,
+                 workers, max_pending, prepare if pool else None)
+
+# Stream-decrypt chunks of (c1, c2) pairs, yielding one list of messages per chunk
+def imap_decrypt(p, private_key, pair_chunks, workers=None, max_pending=None):
+    return _imap(_decrypt_chunk, lambda chunk: (p, private_key, chunk), pair_chunks, workers, max_pending)
+
+# Stream-transform chunks of (c1, c2) pairs without decrypting them: with
+# exponent 0 each pair is re-randomized under `public_key` (same plaintext,
+# fresh randomness); with a re-encryption key as exponent the pairs are
+# moved to `public_key` as well. Pairs from `pool` are used for plain
+# re-randomization when given.
+def imap_rerandomize(p, g, public_key, pair_chunks, exponent=0, workers=None, max_pending=None, pool=None):
+    def prepare(pairs):
+        taken = pool.take_many(len(pairs))
+        head = [(c1 * a % p, c2 * s % p) for (a, s), (c1, c2) in zip(taken, pairs)]
+        return head, pairs[len(taken):]
+
+    return _imap(_rerandomize_chunk, lambda chunk: (p, g, public_key, exponent, chunk), pair_chunks,
+                 workers, max_pending, prepare if pool and not exponent else None)
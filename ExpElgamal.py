@@ -0,0 +1,110 @@
+import os
+import random
+from functools import lru_cache
+import Backend
+import Elgamal
+import Engine
+
+# Exponential ElGamal: a message m is encrypted as (g^k, h^m * y^k), i.e.
+# plain ElGamal of h^m, where h = g^2 generates the quadratic residues (a
+# power g^m of a generator of Z_p^* would give away the parity of m). The
+# scheme is additively homomorphic: multiplying
+# ciphertexts adds their messages and raising a ciphertext to a constant
+# scales its message, so sums over windows of samples (levels, mixes with
+# integer gains) can be computed from the ciphertexts alone. Decryption
+# yields h^m, from which m is recovered by a baby-step giant-step search;
+# this is only practical for small m such as samples and sums of them.
+
+# Baby steps per table: a lookup covers this many messages, so sums up to
+# BABY_STEPS * n need at most n giant steps. Tables are cached per group.
+BABY_STEPS = int(os.environ.get('ELGAMAL_BSGS_STEPS', 1 << 16))
+MESSAGE_BITS = 32
+
+# Base h of the message encoding
+def message_base(p, g):
+    return g * g % p
+
+# Fixed-base table for h^m with m below 2^MESSAGE_BITS (four multiplications)
+@lru_cache(maxsize=16)
+def message_table(p, g):
+    return Elgamal.FixedBaseTable(message_base(p, g), p, MESSAGE_BITS, 8)
+
+# Encode messages as h^m, ready for plain ElGamal encryption
+def lift_many(p, g, messages):
+    h_pow = message_table(p, g).pow
+    h = message_base(p, g)
+    limit = 1 << MESSAGE_BITS
+    return [h_pow(m) if 0 <= m < limit else Backend.powmod(h, m, p) for m in messages]
+
+def encrypt(p, g, public_key, message):
+    return Elgamal.get_public_key(p, g, public_key).encrypt(lift_many(p, g, [message])[0], random.SystemRandom())
+
+# Encrypt many messages on the parallel engine, preserving order
+def encrypt_many(p, g, public_key, messages, workers=None):
+    return Engine.parallel_encrypt(p, g, public_key, lift_many(p, g, messages), workers)
+
+# Homomorphic addition: Enc(a) * Enc(b) = Enc(a + b)
+def add(p, a, b):
+    return a[0] * b[0] % p, a[1] * b[1] % p
+
+# Homomorphic scaling by an integer: Enc(m)^factor = Enc(factor * m)
+def scale(p, pair, factor):
+    return Backend.powmod(pair[0], factor, p), Backend.powmod(pair[1], factor, p)
+
+# Homomorphic sum of many ciphertexts (Enc(0) = (1, 1) for none)
+def combine(p, pairs):
+    mpz = Backend.mpz
+    modulus = mpz(p)
+    c1 = c2 = mpz(1)
+    for a, b in pairs:
+        c1 = c1 * a % modulus
+        c2 = c2 * b % modulus
+    return int(c1), int(c2)
+
+# Sums of consecutive windows of `window` ciphertexts (the last may be shorter)
+def window_sums(p, pairs, window):
+    return [combine(p, pairs[start:start + window]) for start in range(0, len(pairs), window)]
+
+# Baby-step table {h^j: j} for j < size, with the giant step h^-size
+@lru_cache(maxsize=4)
+def baby_steps(p, g, size=BABY_STEPS):
+    h = message_base(p, g)
+    table = {}
+    value = 1
+    for j in range(size):
+        table[value] = j
+        value = value * h % p
+    return table, Backend.invert(value, p)
+
+# Discrete logarithm of h^m for 0 <= m < bound
+def dlog(p, g, value, bound):
+    table, giant = baby_steps(p, g, BABY_STEPS)
+    for step in range(0, bound, BABY_STEPS):
+        j = table.get(value)
+        if j is not None and step + j < bound:
+            return step + j
+        value = value * giant % p
+    raise ValueError(f"Decrypted value is not an encoding below {bound} (wrong private key?)")
+
+def dlog_many(p, g, values, bound):
+    return [dlog(p, g, value, bound) for value in values]
+
+def decrypt(p, g, private_key, pair, bound):
+    return dlog(p, g, Elgamal.elgamal_decrypt(p, private_key, *pair), bound)
+
+# Decrypt ciphertexts of messages known to lie in [0, bound)
+def decrypt_many(p, g, private_key, pairs, bound):
+    return dlog_many(p, g, Elgamal.elgamal_decrypt_many(p, private_key, pairs), bound)
+
+if __name__ == '__main__':
+    private_key, public_key, p, g = Elgamal.elgamal_keygen(128)
+    samples = [0, 1, 32768, 65535, 12345, 54321, 7, 8, 9]
+    pairs = encrypt_many(p, g, public_key, samples, workers=1)
+    print(f"Decrypted samples: {decrypt_many(p, g, private_key, pairs, 1 << 16)}")
+
+    total = combine(p, pairs)
+    print(f"Encrypted sum decrypts to {decrypt(p, g, private_key, total, len(samples) << 16)} "
+          f"(expected {sum(samples)})")
+    sums = window_sums(p, pairs, 4)
+    print(f"Window sums: {decrypt_many(p, g, private_key, sums, 4 << 16)}")
+    print(f"Sum with gain 3: {decrypt(p, g, private_key, scale(p, total, 3), 3 * len(samples) << 16)}")
@@ -0,0 +1,80 @@
+import hashlib
+import hmac
+import secrets
+import Backend
+
+# Hybrid KEM/DEM mode: ElGamal encapsulates a fresh session key once per file,
+# and the PCM samples are encrypted in chunks with a SHAKE-256 keystream and a
+# keyed BLAKE2b tag (encrypt-then-MAC) using only the standard library.
+
+KEY_SIZE = 32
+TAG_SIZE = 16
+# Samples per chunk in the legacy text format (containers record their own)
+CHUNK_SAMPLES = 4096
+
+# Derive the symmetric encryption and MAC keys from the shared ElGamal secret
+def derive_keys(p, shared):
+    shared_bytes = shared.to_bytes((p.bit_length() + 7) // 8, 'big')
+    material = hashlib.blake2b(shared_bytes, digest_size=2 * KEY_SIZE, person=b'elgamal-kem').digest()
+    return material[:KEY_SIZE], material[KEY_SIZE:]
+
+# ElGamal key encapsulation: returns c1 = g^k and the derived session keys
+def encapsulate(p, g, public_key):
+    k = secrets.randbelow(p - 2) + 1
+    c1 = Backend.powmod(g, k, p)
+    return c1, derive_keys(p, Backend.powmod(public_key, k, p))
+
+# ElGamal key decapsulation: recovers the session keys from c1
+def decapsulate(p, private_key, c1):
+    return derive_keys(p, Backend.powmod(c1, private_key, p))
+
+def _keystream(enc_key, index, length):
+    return hashlib.shake_256(enc_key + index.to_bytes(8, 'big')).digest(length)
+
+# The tag covers the chunk index, the final flag and any associated data
+# (length-prefixed, and left out entirely when empty so tags made before it
+# existed still verify)
+def _tag(mac_key, index, final, ciphertext, associated=b''):
+    header = index.to_bytes(8, 'big') + (b'\x01' if final else b'\x00')
+    if associated:
+        header += len(associated).to_bytes(4, 'big') + associated
+    return hashlib.blake2b(header + ciphertext, key=mac_key, digest_size=TAG_SIZE).digest()
+
+# Encrypt and authenticate one chunk of plaintext bytes. `associated` is
+# authenticated but not encrypted.
+def encrypt_chunk(keys, index, data, final=False, associated=b''):
+    enc_key, mac_key = keys
+    stream = _keystream(enc_key, index, len(data))
+    ciphertext = (int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(len(data), 'little')
+    return ciphertext, _tag(mac_key, index, final, ciphertext, associated)
+
+# Verify and decrypt one chunk of ciphertext bytes
+def decrypt_chunk(keys, index, ciphertext, tag, final=False, associated=b''):
+    enc_key, mac_key = keys
+    if not hmac.compare_digest(tag, _tag(mac_key, index, final, ciphertext, associated)):
+        raise ValueError(f"Authentication failed for chunk {index}")
+    stream = _keystream(enc_key, index, len(ciphertext))
+    return (int.from_bytes(ciphertext, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(len(ciphertext), 'little')
+
+# Move one authenticated chunk from `old_keys` to `new_keys` without forming
+# the plaintext: the old tag is verified and the ciphertext is XORed with
+# both keystreams at once
+def rekey_chunk(old_keys, new_keys, index, ciphertext, tag, final=False, associated=b''):
+    if not hmac.compare_digest(tag, _tag(old_keys[1], index, final, ciphertext, associated)):
+        raise ValueError(f"Authentication failed for chunk {index}")
+    length = len(ciphertext)
+    streams = (int.from_bytes(_keystream(old_keys[0], index, length), 'little')
+               ^ int.from_bytes(_keystream(new_keys[0], index, length), 'little'))
+    rekeyed = (int.from_bytes(ciphertext, 'little') ^ streams).to_bytes(length, 'little')
+    return rekeyed, _tag(new_keys[1], index, final, rekeyed, associated)
+
+if __name__ == '__main__':
+    import Elgamal
+
+    private_key, public_key, p, g = Elgamal.elgamal_keygen(128)
+    data = bytes(range(256)) * 64
+    c1, keys = encapsulate(p, g, public_key)
+    ciphertext, tag = encrypt_chunk(keys, 0, data, final=True)
+    print(f"Encapsulated key: c1 = {c1}, {len(ciphertext)} ciphertext bytes")
+    recovered = decrypt_chunk(decapsulate(p, private_key, c1), 0, ciphertext, tag, final=True)
+    print(f"Round trip ok: {recovered == data}")
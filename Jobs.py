@@ -0,0 +1,96 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Background job subsystem for the Flask routes. A submitted job runs on a
+# small thread pool (the crypto itself runs on the Engine process pool),
+# reports progress as samples done/total, and keeps its output in its own
+# directory until it is evicted from the bounded job store. The store holds
+# at most MAX_JOBS jobs: finished ones are evicted oldest first, and while
+# every slot is taken by a queued or running job new jobs are refused.
+
+JOBS_DIR = os.environ.get('ELGAMAL_JOBS_DIR', 'jobs')
+JOB_WORKERS = int(os.environ.get('ELGAMAL_JOB_WORKERS', 4))
+MAX_JOBS = int(os.environ.get('ELGAMAL_MAX_JOBS', 64))
+
+class Job:
+    def __init__(self, kind, total=0):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.total = total
+        self.done = 0
+        self.error = None
+        self.result_path = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.directory = os.path.join(JOBS_DIR, self.id)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def advance(self, samples):
+        self.done += samples
+
+    def to_dict(self):
+        elapsed = (self.finished or time.time()) - self.started if self.started else 0
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'samples_done': self.done,
+            'samples_total': self.total,
+            'progress': self.done / self.total if self.total else 0.0,
+            'samples_per_second': self.done / elapsed if elapsed else 0.0,
+            'error': self.error,
+        }
+
+class JobManager:
+    def __init__(self, workers=JOB_WORKERS, max_jobs=MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, kind, total=0):
+        with self._lock:
+            self._evict()
+            if len(self._jobs) >= self.max_jobs:
+                raise ValueError(f"Too many jobs in progress (at most {self.max_jobs}); try again later.")
+            job = Job(kind, total)
+            self._jobs[job.id] = job
+        return job
+
+    # Run `function(job)` in the background; its return value is the result file path
+    def submit(self, job, function):
+        def run():
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                job.result_path = function(job)
+                job.status = 'done'
+            except Exception as e:
+                job.error = str(e)
+                job.status = 'failed'
+            finally:
+                job.finished = time.time()
+
+        self._executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Drop the oldest finished jobs (and their files) to make room for a new one
+    def _evict(self):
+        finished = [job for job in self._jobs.values() if job.status in ('done', 'failed')]
+        for job in finished[:max(0, len(self._jobs) - self.max_jobs + 1)]:
+            del self._jobs[job.id]
+            shutil.rmtree(job.directory, ignore_errors=True)
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import Elgamal
+import Hybrid
+
+# Key store for the web app. Keys are addressed by a key id (kept in the
+# user's session), evicted LRU-first and after a TTL, and held by a
+# pluggable backend: in-memory for a single process, or SQLite so that
+# several worker processes share the same keys. The per-key acceleration
+# data (fixed-base tables) lives in Elgamal.get_public_key's cache, which
+# the parallel engine and the ephemeral pools also draw on, so each process
+# builds it once per key.
+#
+# The SQLite backend keeps private keys encrypted under a secret shared by
+# the workers (ELGAMAL_KEYSTORE_SECRET, or else FLASK_SECRET_KEY), so the
+# database file alone does not give them away.
+
+KEYSTORE = os.environ.get('ELGAMAL_KEYSTORE', 'memory')
+MAX_KEYS = int(os.environ.get('ELGAMAL_MAX_KEYS', 1024))
+KEY_TTL = float(os.environ.get('ELGAMAL_KEY_TTL', 3600))
+
+FIELDS = ('p', 'g', 'public_key', 'private_key')
+KEYSTORE_SECRET = os.environ.get('ELGAMAL_KEYSTORE_SECRET') or os.environ.get('FLASK_SECRET_KEY')
+
+# Backends are shared by the request threads, so each guards its own state
+class MemoryBackend:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key_id):
+        with self._lock:
+            return self._entries.get(key_id)
+
+    def put(self, key_id, entry):
+        with self._lock:
+            self._entries[key_id] = entry
+
+    def delete(self, key_id):
+        with self._lock:
+            self._entries.pop(key_id, None)
+
+    def purge(self, now):
+        with self._lock:
+            for key_id in [key_id for key_id, entry in list(self._entries.items()) if entry['expires'] < now]:
+                del self._entries[key_id]
+
+class SQLiteBackend:
+    def __init__(self, path, secret=KEYSTORE_SECRET):
+        if not secret:
+            raise ValueError("The SQLite key store needs ELGAMAL_KEYSTORE_SECRET (or FLASK_SECRET_KEY) "
+                             "to encrypt the private keys it stores")
+        self.path = path
+        self._secret = hashlib.blake2b(secret.encode(), person=b'elgamal-keystore').digest()
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS keys (key_id TEXT PRIMARY KEY, p TEXT, g TEXT, '
+                       'public_key TEXT, private_key TEXT, expires REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    # Encryption and MAC keys for one entry; every key id is random and its
+    # private key is written once, so chunk index 0 never repeats under a key
+    def _keys(self, key_id):
+        material = hashlib.blake2b(key_id.encode(), key=self._secret, digest_size=2 * Hybrid.KEY_SIZE).digest()
+        return material[:Hybrid.KEY_SIZE], material[Hybrid.KEY_SIZE:]
+
+    def _seal(self, key_id, private_key):
+        data = private_key.to_bytes((private_key.bit_length() + 7) // 8 or 1, 'big')
+        ciphertext, tag = Hybrid.encrypt_chunk(self._keys(key_id), 0, data, True)
+        return (ciphertext + tag).hex()
+
+    def _open(self, key_id, sealed):
+        payload = bytes.fromhex(sealed)
+        data = Hybrid.decrypt_chunk(self._keys(key_id), 0, payload[:-Hybrid.TAG_SIZE], payload[-Hybrid.TAG_SIZE:], True)
+        return int.from_bytes(data, 'big')
+
+    def get(self, key_id):
+        with self._connect() as db:
+            row = db.execute('SELECT p, g, public_key, private_key, expires FROM keys WHERE key_id = ?',
+                             (key_id,)).fetchone()
+        if row is None:
+            return None
+        entry = {field: int(value) for field, value in zip(FIELDS[:-1], row)}
+        try:
+            entry['private_key'] = self._open(key_id, row[3])
+        except ValueError:
+            return None  # stored under another secret (or tampered with)
+        entry['expires'] = row[-1]
+        return entry
+
+    def put(self, key_id, entry):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?)',
+                       (key_id, *(str(entry[field]) for field in FIELDS[:-1]),
+                        self._seal(key_id, entry['private_key']), entry['expires']))
+
+    def delete(self, key_id):
+        with self._connect() as db:
+            db.execute('DELETE FROM keys WHERE key_id = ?', (key_id,))
+
+    def purge(self, now):
+        with self._connect() as db:
+            db.execute('DELETE FROM keys WHERE expires < ?', (now,))
+
+# Backend from a spec: 'memory' or 'sqlite:<path>'
+def make_backend(spec=KEYSTORE):
+    if spec == 'memory':
+        return MemoryBackend()
+    if spec.startswith('sqlite:'):
+        return SQLiteBackend(spec[len('sqlite:'):])
+    raise ValueError(f"Unknown key store backend: {spec}")
+
+class KeyStore:
+    def __init__(self, backend=None, max_keys=MAX_KEYS, ttl=KEY_TTL):
+        self.backend = backend or make_backend()
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._cache = OrderedDict()  # key_id -> entry with cached acceleration data
+        self._lock = threading.Lock()
+
+    def create(self, p, g, public_key, private_key):
+        key_id = uuid.uuid4().hex
+        entry = {'p': p, 'g': g, 'public_key': public_key, 'private_key': private_key,
+                 'expires': time.time() + self.ttl}
+        self.backend.purge(time.time())
+        self.backend.put(key_id, entry)
+        with self._lock:
+            self._remember(key_id, entry)
+        return key_id
+
+    # Look up a key; returns None when it is unknown or expired
+    def get(self, key_id):
+        if not key_id:
+            return None
+        with self._lock:
+            entry = self._cache.get(key_id)
+            if entry is not None:
+                self._cache.move_to_end(key_id)
+        if entry is None:
+            entry = self.backend.get(key_id)
+            if entry is None:
+                return None
+            with self._lock:
+                self._remember(key_id, entry)
+        if entry['expires'] < time.time():
+            self.delete(key_id)
+            return None
+        return entry
+
+    def delete(self, key_id):
+        self.backend.delete(key_id)
+        with self._lock:
+            self._cache.pop(key_id, None)
+
+    # Cached ElGamalPublicKey (fixed-base tables) for a key, shared with the engine
+    def public_key(self, key_id):
+        entry = self.get(key_id)
+        if entry is None:
+            return None
+        return Elgamal.get_public_key(entry['p'], entry['g'], entry['public_key'])
+
+    def _remember(self, key_id, entry):
+        self._cache[key_id] = entry
+        self._cache.move_to_end(key_id)
+        while len(self._cache) > self.max_keys:
+            oldest, _ = self._cache.popitem(last=False)
+            if isinstance(self.backend, MemoryBackend):
+                self.backend.delete(oldest)
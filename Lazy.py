@@ -0,0 +1,30 @@
+import importlib
+import importlib.util
+
+# Heavy dependencies (numpy, gmpy2, ...) are bound through Lazy.Module so
+# that importing this package, starting the CLI or a short-lived web worker
+# does not pay for them until they are first used:
+#
+#   np = Lazy.Module('numpy')
+#   np.frombuffer(...)   # numpy is imported here
+#
+# The import goes through importlib, whose module locks make concurrent
+# first use from several threads safe. Attributes are cached on the
+# stand-in after the first lookup, so later accesses cost a plain
+# attribute read.
+
+class Module:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attribute):
+        value = getattr(importlib.import_module(self._name), attribute)
+        self.__dict__[attribute] = value
+        return value
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+# Whether a module can be imported, without importing it
+def available(name):
+    return importlib.util.find_spec(name) is not None
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import Lazy
+
+# Process-wide instrumentation for the encryption pipeline: timing spans per
+# stage (keygen, wav_read, encrypt, serialize, parse, decrypt, wav_write,
+# compare, aggregate, reencrypt), per-stage counters (samples, bytes in/out, modular
+# exponentiations), a Prometheus text renderer and an opt-in cProfile hook.
+#
+# Span times are exclusive: while a nested span runs (e.g. wav_read pulled
+# from inside an encrypt step) its time is not charged to the outer stage.
+
+# Only loaded once profiling is switched on
+cProfile = Lazy.Module('cProfile')
+
+# Set ELGAMAL_PROFILING=1 to allow profiling; profiles go to ELGAMAL_PROFILE_DIR
+PROFILING = os.environ.get('ELGAMAL_PROFILING') == '1'
+PROFILE_DIR = os.environ.get('ELGAMAL_PROFILE_DIR', 'profiles')
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    'elgamal_samples_total': 'Audio samples processed per stage',
+    'elgamal_bytes_in_total': 'Bytes consumed per stage',
+    'elgamal_bytes_out_total': 'Bytes produced per stage',
+    'elgamal_modexp_total': 'Modular exponentiations per stage',
+    'elgamal_stage_seconds': 'Time per pipeline span, excluding nested spans',
+    'elgamal_http_requests_total': 'HTTP requests per endpoint and status',
+    'elgamal_http_request_seconds': 'Time until the response headers are ready, per endpoint',
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_local = threading.local()
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry[i] += 1
+        entry[-2] += seconds
+        entry[-1] += 1
+
+# Add per-stage counters (samples, bytes_in, bytes_out, modexp)
+def count(stage, **values):
+    for name, value in values.items():
+        if value:
+            inc(f'elgamal_{name}_total', value, stage=stage)
+
+# Time a block as one span of `stage`
+@contextmanager
+def span(stage):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        observe('elgamal_stage_seconds', elapsed - nested, stage=stage)
+
+# Time each step of an iterator as a span of `stage`
+def timed(stage, iterable):
+    iterator = iter(iterable)
+    while True:
+        with span(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+# Render every metric in the Prometheus text exposition format
+def render():
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items())
+    lines = []
+    described = set()
+    for (name, labels), value in counters:
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+            lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), entry in histograms:
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+        for bound, bucket in zip(BUCKETS, entry):
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {bucket}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {entry[-1]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {entry[-2]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {entry[-1]}')
+    return '\n'.join(lines) + '\n'
+
+# Per-stage totals as {stage: {'seconds': ..., 'spans': ..., counter: ...}}
+def summary():
+    with _lock:
+        counters = list(_counters.items())
+        histograms = list(_histograms.items())
+    stages = {}
+    for (name, labels), entry in histograms:
+        if name == 'elgamal_stage_seconds':
+            stage = stages.setdefault(dict(labels)['stage'], {})
+            stage['seconds'] = entry[-2]
+            stage['spans'] = entry[-1]
+    for (name, labels), value in counters:
+        stage = dict(labels).get('stage')
+        if stage is not None:
+            stages.setdefault(stage, {})[name[len('elgamal_'):-len('_total')]] = value
+    return stages
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+# Profile a block when profiling is enabled; yields the Profile or None
+@contextmanager
+def profiled(name, enabled=None):
+    profile = Profile(name) if (PROFILING if enabled is None else enabled) else None
+    try:
+        yield profile
+    finally:
+        if profile is not None:
+            profile.stop()
+
+# cProfile the current thread until `stop()`, which writes the stats to `path`
+class Profile:
+    def __init__(self, name, directory=None):
+        self.path = os.path.join(directory or PROFILE_DIR,
+                                 f'{time.strftime("%Y%m%d-%H%M%S")}-{name}-{os.urandom(4).hex()}.prof')
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.profiler.dump_stats(self.path)
+        return self.path
@@ -0,0 +1,171 @@
+import json
+import math
+import os
+import random
+import threading
+from collections import namedtuple
+import Backend
+
+# Key-parameter subsystem: Miller-Rabin prime generation with small-prime
+# sieving, safe-prime (p = 2q + 1) and Schnorr (p = kq + 1) groups,
+# generators proven from the known factorisation of p - 1, and an on-disk
+# cache of validated groups so per-user key generation is a single modexp.
+
+CACHE_FILE = os.environ.get('ELGAMAL_PARAMS_CACHE', os.path.expanduser('~/.cache/elgamal/groups.json'))
+SCHNORR_Q_BITS = 256
+
+Group = namedtuple('Group', 'kind p q g')
+
+_rng = random.SystemRandom()
+_groups = {}
+_lock = threading.Lock()
+
+def _small_primes(limit):
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b'\x00\x00'
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytearray(len(sieve[i * i::i]))
+    return [i for i in range(limit) if sieve[i]]
+
+SMALL_PRIMES = _small_primes(2000)
+PRIMORIAL = math.prod(SMALL_PRIMES)
+
+# Miller-Rabin probabilistic primality test
+def is_probable_prime(n, rounds=40):
+    if n < 2:
+        return False
+    for prime in SMALL_PRIMES[:50]:
+        if n % prime == 0:
+            return n == prime
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in range(rounds):
+        x = Backend.powmod(_rng.randrange(2, n - 1), d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = Backend.powmod(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+# Random prime of exactly `bits` bits; candidates sharing a factor with
+# the small-prime primorial are rejected before Miller-Rabin
+def random_prime(bits):
+    while True:
+        n = _rng.getrandbits(bits) | (1 << (bits - 1)) | 1
+        if math.gcd(n, PRIMORIAL) == 1 and is_probable_prime(n):
+            return n
+
+# Safe prime p = 2q + 1 with q prime; both are sieved together and given a
+# single Miller-Rabin round before the full test
+def generate_safe_prime(bits):
+    while True:
+        q = _rng.getrandbits(bits - 1) | (1 << (bits - 2)) | 1
+        p = 2 * q + 1
+        if math.gcd(q * p, PRIMORIAL) != 1:
+            continue
+        if not is_probable_prime(q, 1) or not is_probable_prime(p, 1):
+            continue
+        if is_probable_prime(q) and is_probable_prime(p):
+            return p, q
+
+# Schnorr group: prime q of `q_bits` bits and prime p = kq + 1 of `bits` bits
+def generate_schnorr_prime(bits, q_bits=SCHNORR_Q_BITS):
+    q = random_prime(q_bits)
+    while True:
+        k = _rng.getrandbits(bits - q_bits) | (1 << (bits - q_bits - 1))
+        k += k % 2  # keep p odd
+        p = k * q + 1
+        if p.bit_length() == bits and math.gcd(p, PRIMORIAL) == 1 and is_probable_prime(p):
+            return p, q
+
+# Generator of the full group Z_p^*, given the distinct prime factors of p - 1
+def find_generator(p, factors):
+    for g in range(2, p):
+        if all(Backend.powmod(g, (p - 1) // f, p) != 1 for f in factors):
+            return g
+    raise ValueError(f"No generator found for prime {p}")
+
+# Generator of the subgroup of prime order q
+def find_subgroup_generator(p, q):
+    exponent = (p - 1) // q
+    for h in range(2, p):
+        g = Backend.powmod(h, exponent, p)
+        if g != 1:
+            return g
+    raise ValueError(f"No subgroup generator found for prime {p}")
+
+def generate_group(bits, kind='safe'):
+    if kind == 'safe':
+        p, q = generate_safe_prime(bits)
+        return Group(kind, p, q, find_generator(p, (2, q)))
+    if kind == 'schnorr':
+        p, q = generate_schnorr_prime(bits)
+        return Group(kind, p, q, find_subgroup_generator(p, q))
+    raise ValueError(f"Unknown group kind: {kind}")
+
+# Check primality of p and q and that g has the expected order
+def validate_group(group, rounds=8):
+    p, q, g = group.p, group.q, group.g
+    if not (is_probable_prime(q, rounds) and is_probable_prime(p, rounds)) or (p - 1) % q:
+        return False
+    if not 1 < g < p - 1:
+        return False
+    if group.kind == 'safe':
+        return p == 2 * q + 1 and Backend.powmod(g, 2, p) != 1 and Backend.powmod(g, q, p) != 1
+    return Backend.powmod(g, q, p) == 1
+
+def _cache_key(bits, kind):
+    return f"{kind}-{bits}"
+
+def _load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(temp_path, path)
+
+# Default group kind: always a safe prime. Samples are encrypted directly
+# as quadratic residues (Elgamal.encode_messages), which only hides them
+# when the residues form a group of prime order q = (p - 1) / 2; in a
+# Schnorr group a sample m outside the order-q subgroup is given away by
+# c2^q = m^q. Schnorr groups can still be asked for explicitly, e.g. for
+# the hybrid and additive modes, whose messages are powers of g.
+def default_kind(bits):
+    return 'safe'
+
+# Return a validated group for `bits`, generating and caching one if needed
+def get_group(bits, kind=None, cache_file=None):
+    kind = kind or default_kind(bits)
+    cache_file = cache_file or CACHE_FILE
+    key = _cache_key(bits, kind)
+    with _lock:
+        if key in _groups:
+            return _groups[key]
+        cache = _load_cache(cache_file)
+        for entry in cache.get(key, []):
+            group = Group(kind, int(entry['p']), int(entry['q']), int(entry['g']))
+            if validate_group(group):
+                _groups[key] = group
+                return group
+        group = generate_group(bits, kind)
+        cache[key] = [{'p': str(group.p), 'q': str(group.q), 'g': str(group.g)}]
+        try:
+            _save_cache(cache_file, cache)
+        except OSError:
+            pass  # the cache is an optimisation only
+        _groups[key] = group
+        return group
@@ -0,0 +1,112 @@
+import os
+import random
+import threading
+from collections import OrderedDict, deque
+import Elgamal
+
+# Offline ephemeral-pair pool. A background thread keeps a bounded stock of
+# precomputed (c1, s) = (g^k, y^k) pairs per public key so the online
+# encryption step is a single modular multiplication c2 = m * s mod p.
+# Every pair is removed from the pool when it is handed out, so it is
+# never used twice.
+
+POOL_SIZE = int(os.environ.get('ELGAMAL_POOL_SIZE', 16384))
+MAX_POOLS = 8
+
+class EphemeralPool:
+    def __init__(self, p, g, public_key, size=POOL_SIZE, low_watermark=None, batch=256, key=None):
+        self.p = p
+        self.key = key or Elgamal.get_public_key(p, g, public_key)
+        self.size = size
+        self.low_watermark = size // 2 if low_watermark is None else low_watermark
+        self.batch = batch
+        self.hits = 0
+        self.misses = 0
+        self.produced = 0
+        self.refills = 0
+        self._pairs = deque()
+        self._rng = random.SystemRandom()
+        self._lock = threading.Lock()
+        self._refill = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _make_pair(self):
+        k = self._rng.randint(1, self.p - 2)
+        return self.key.g_table.pow(k), self.key.y_table.pow(k)
+
+    # Producer loop: fill up to `size`, then sleep until stock drops below the low watermark
+    def _produce(self):
+        while True:
+            with self._refill:
+                while not self._stopped and len(self._pairs) >= self.size:
+                    self._refill.wait()
+                if self._stopped:
+                    return
+                needed = min(self.batch, self.size - len(self._pairs))
+            pairs = [self._make_pair() for _ in range(needed)]
+            with self._lock:
+                self._pairs.extend(pairs)
+                self.produced += len(pairs)
+
+    def _wake_producer(self):
+        if len(self._pairs) < self.low_watermark:
+            self.refills += 1
+            self._refill.notify()
+
+    # Take up to n ready pairs; each pair leaves the pool exactly once
+    def take_many(self, n):
+        with self._lock:
+            count = min(n, len(self._pairs))
+            pairs = [self._pairs.popleft() for _ in range(count)]
+            self.hits += count
+            self.misses += n - count
+            self._wake_producer()
+        return pairs
+
+    # Online encryption: a pooled pair when available, otherwise computed inline
+    def encrypt(self, message):
+        pairs = self.take_many(1)
+        c1, s = pairs[0] if pairs else self._make_pair()
+        return c1, (message * s) % self.p
+
+    def encrypt_many(self, messages):
+        pairs = self.take_many(len(messages))
+        pairs.extend(self._make_pair() for _ in range(len(messages) - len(pairs)))
+        p = self.p
+        return [(c1, (message * s) % p) for (c1, s), message in zip(pairs, messages)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'available': len(self._pairs),
+                'size': self.size,
+                'low_watermark': self.low_watermark,
+                'hits': self.hits,
+                'misses': self.misses,
+                'produced': self.produced,
+                'refills': self.refills,
+            }
+
+    def stop(self):
+        with self._refill:
+            self._stopped = True
+            self._refill.notify()
+
+_pools = OrderedDict()
+_pools_lock = threading.Lock()
+
+# Return the pool for a public key, starting its producer on first use.
+# `key` may supply an already built Elgamal.ElGamalPublicKey.
+def get_pool(p, g, public_key, key=None):
+    with _pools_lock:
+        pool = _pools.get((p, g, public_key))
+        if pool is None:
+            pool = _pools[(p, g, public_key)] = EphemeralPool(p, g, public_key, key=key)
+            if len(_pools) > MAX_POOLS:
+                _, oldest = _pools.popitem(last=False)
+                oldest.stop()
+        else:
+            _pools.move_to_end((p, g, public_key))
+        return pool
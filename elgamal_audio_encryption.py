@@ -1,97 +1,131 @@
 import wave
-import struct
 import random
 import os
+import sys
+import Audio
+import Backend
+import Container
+import Elgamal
+import Metrics
+import Params
+
+KEY_BITS = 128
+KEY_DIR = os.path.expanduser('~/Downloads/encryption_keys/')
+
+# Optional Prometheus text file for the per-stage metrics of each run
+# (e.g. for a node_exporter textfile collector)
+METRICS_FILE = os.environ.get('ELGAMAL_METRICS_FILE')
 
 def log_message(message, log_file):
     print(message)
     with open(log_file, 'a') as f:
         f.write(message + '\n')
 
-def find_large_prime(bit_length=32, log_file=''):
+def find_large_prime(bit_length=128, log_file=''):
     log_message("Generating a large prime number...", log_file)
-    
-    def is_prime(n):
-        if n <= 1:
-            return False
-        if n <= 3:
-            return True
-        if n % 2 == 0 or n % 3 == 0:
-            return False
-        i = 5
-        while i * i <= n:
-            if n % i == 0 or n % (i + 2) == 0:
-                return False
-            i += 6
-        return True
-    
-    while True:
-        p_candidate = random.getrandbits(bit_length)
-        if is_prime(p_candidate):
-            log_message(f"Large prime found: {p_candidate}", log_file)
-            return p_candidate
+    p_candidate = Params.random_prime(bit_length)
+    log_message(f"Large prime found: {p_candidate}", log_file)
+    return p_candidate
 
-def find_generator(p, log_file=''):
+def find_generator(p, log_file='', factors=None):
     log_message("Finding generator for prime number...", log_file)
-    for g in range(2, p):
-        if pow(g, 2, p) != 1 and pow(g, (p - 1) // 2, p) != 1:
-            log_message(f"Generator found: {g}", log_file)
-            return g
+    if factors is None:
+        # Without the factorisation of p - 1 only safe primes can be handled
+        q = (p - 1) // 2
+        if not Params.is_probable_prime(q):
+            raise ValueError(f"Prime {p} is not a safe prime; pass the factors of p - 1")
+        factors = (2, q)
+    g = Params.find_generator(p, factors)
+    log_message(f"Generator found: {g}", log_file)
+    return g
+
+# Load (or generate and cache) the group parameters p and g
+def load_group(bit_length=KEY_BITS, log_file=''):
+    log_message(f"Loading {bit_length}-bit group parameters...", log_file)
+    with Metrics.span('keygen'):
+        group = Params.get_group(bit_length)
+    log_message(f"Using {group.kind} group with prime {group.p}", log_file)
+    return group.p, group.g
 
 def generate_keys(p, g, log_file=''):
     log_message("Generating public and private key pair...", log_file)
-    private_key = random.randint(1, p - 1)
-    public_key = pow(g, private_key, p)
+    with Metrics.span('keygen'):
+        private_key = Elgamal.random_private_key(p)
+        public_key = Backend.powmod(g, private_key, p)
+    Metrics.count('keygen', modexp=1)
     log_message(f"Private key: {private_key}, Public key: {public_key}", log_file)
 
     # Save the keys to files
-    key_dir = os.path.expanduser('~/Downloads/encryption_keys/')
-    os.makedirs(key_dir, exist_ok=True)
+    os.makedirs(KEY_DIR, exist_ok=True)
     
-    with open(os.path.join(key_dir, 'private_key.txt'), 'w') as f:
+    with open(os.path.join(KEY_DIR, 'private_key.txt'), 'w') as f:
         f.write(str(private_key))
     
-    with open(os.path.join(key_dir, 'public_key.txt'), 'w') as f:
+    with open(os.path.join(KEY_DIR, 'public_key.txt'), 'w') as f:
         f.write(str(public_key))
     
-    log_message(f"Keys saved to {key_dir}", log_file)
+    log_message(f"Keys saved to {KEY_DIR}", log_file)
     return private_key, public_key
 
+# Private key saved by generate_keys, or None if there is none
+def load_saved_private_key():
+    try:
+        with open(os.path.join(KEY_DIR, 'private_key.txt'), 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+# Parse "start-end" in seconds (either side may be left out)
+def parse_time_range(text):
+    start, _, end = text.partition('-')
+    return float(start or 0), float(end) if end.strip() else None
+
 def elgamal_encrypt(p, g, public_key, message):
-    k = random.randint(1, p - 2)
-    c1 = pow(g, k, p)
-    c2 = (message * pow(public_key, k, p)) % p
+    k = random.SystemRandom().randint(1, p - 2)
+    c1 = Backend.powmod(g, k, p)
+    c2 = (message * Backend.powmod(public_key, k, p)) % p
     return c1, c2
 
 def elgamal_decrypt(p, private_key, c1, c2):
-    s = pow(c1, private_key, p)
-    s_inv = pow(s, p - 2, p)
+    s = Backend.powmod(c1, private_key, p)
+    s_inv = Backend.invert(s, p)
     m = (c2 * s_inv) % p
     return m
 
 def audio_to_binary(audio_file, log_file=''):
     log_message(f"Converting audio file '{audio_file}' to binary...", log_file)
-    with wave.open(audio_file, 'rb') as wave_file:
+    with Metrics.span('wav_read'), wave.open(audio_file, 'rb') as wave_file:
         params = wave_file.getparams()
         audio_data = wave_file.readframes(wave_file.getnframes())
-        binary_data = struct.unpack('<' + 'h' * (len(audio_data) // 2), audio_data)
+        binary_data = Audio.bytes_to_samples(audio_data, params.sampwidth)
+    Metrics.count('wav_read', samples=len(binary_data), bytes_in=len(audio_data))
     log_message(f"Extracted {len(binary_data)} samples from audio.", log_file)
     return binary_data, params
 
 def binary_to_audio(binary_data, params, audio_file, log_file=''):
     log_message(f"Converting binary data back to audio and saving as '{audio_file}'...", log_file)
-    try:
-        audio_data = struct.pack('<' + 'h' * len(binary_data), *binary_data)
-    except struct.error as e:
-        log_message(f"Error in packing data: {e}", log_file)
-        binary_data = [max(-32768, min(32767, value)) for value in binary_data]
-        audio_data = struct.pack('<' + 'h' * len(binary_data), *binary_data)
-    
-    with wave.open(audio_file, 'wb') as wave_file:
-        wave_file.setparams(params)
-        wave_file.writeframes(audio_data)
+    with Metrics.span('wav_write'):
+        # Out-of-range values are clipped to the sample width
+        audio_data = Audio.samples_to_bytes(binary_data, params.sampwidth)
+
+        with wave.open(audio_file, 'wb') as wave_file:
+            wave_file.setparams(params)
+            wave_file.writeframes(audio_data)
+    Metrics.count('wav_write', samples=len(binary_data), bytes_out=len(audio_data))
     log_message(f"Written {len(binary_data)} samples to '{audio_file}'.", log_file)
 
+# Log the per-stage timings and counters collected so far, and write them
+# to METRICS_FILE when it is set
+def report_metrics(log_file):
+    for stage, values in sorted(Metrics.summary().items()):
+        details = ', '.join(f"{name}={value:.4f}" if isinstance(value, float) else f"{name}={value}"
+                            for name, value in sorted(values.items()))
+        log_message(f"[metrics] {stage}: {details}", log_file)
+    if METRICS_FILE:
+        with open(METRICS_FILE + '.tmp', 'w') as f:
+            f.write(Metrics.render())
+        os.replace(METRICS_FILE + '.tmp', METRICS_FILE)
+
 def main():
     # Define paths
     # Get the current directory of the application
@@ -106,6 +140,12 @@ def main():
     os.makedirs(encrypted_dir, exist_ok=True)
     os.makedirs(decrypted_dir, exist_ok=True)
 
+    # Key material and WAV parameters from the last encryption in this session
+    p = g = public_key = params = None
+
+    # Set ELGAMAL_BACKEND=python|gmpy2 to override the arithmetic backend
+    print(f"Arithmetic backend: {Backend.name}")
+
     while True:
         print("\nElGamal Encryption Program - Menu")
         print("1. Encryption")
@@ -116,39 +156,58 @@ def main():
         if option == '1':
             # Encryption
             input_file = input("Enter the path to the audio file to encrypt: ").strip()
-            encrypted_file = os.path.join(encrypted_dir, 'encrypted_data.txt')
+            encrypted_file = os.path.join(encrypted_dir, 'encrypted_data.bin')
             log_file = os.path.join(decrypted_dir, 'terminal_output.txt')
             
             if not os.path.isfile(input_file):
                 print("Audio file does not exist. Please check the path.")
                 continue
             
-            # Generate prime and generator
-            p = find_large_prime(32, log_file)
-            g = find_generator(p, log_file)
-            
-            log_message(f"Prime number (p): {p}, Generator (g): {g}", log_file)
-            
-            # Generate keys
-            private_key, public_key = generate_keys(p, g, log_file)
+            # An interrupted encryption of the same file can carry on with its key
+            manifest = Container.load_manifest(encrypted_file)
+            resume = (manifest is not None and not manifest['complete']
+                      and manifest['source'] == Container.source_info(input_file)
+                      and input("An interrupted encryption of this file was found. "
+                                "Resume it? (y/n) [y]: ").strip().lower() != 'n')
 
-            # Convert audio to binary
-            binary_data, params = audio_to_binary(input_file, log_file)
+            if resume:
+                mode = manifest['mode']
+            else:
+                mode = input("Encryption mode (sample/packed/hybrid/additive) [sample]: ").strip().lower() or 'sample'
+                if mode not in Container.MODES:
+                    print("Invalid mode. Please choose sample, packed, hybrid or additive.")
+                    continue
 
-            # Adjust sample values to be in range [0, 65535]
-            adjusted_data = [sample + 32768 for sample in binary_data]
+            # Set ELGAMAL_PROFILING=1 to write a cProfile file for this run
+            with Metrics.profiled('encrypt') as profile:
+                if resume:
+                    p, g, public_key = manifest['p'], manifest['g'], manifest['public_key']
+                    private_key = load_saved_private_key()
+                    log_message(f"Resuming after {manifest['samples']} encrypted samples "
+                                f"with the key from {KEY_DIR}", log_file)
+                else:
+                    # Load the cached prime and generator
+                    p, g = load_group(KEY_BITS, log_file)
 
-            # Encrypt the binary data
-            encrypted_data = []
-            log_message("Encrypting binary data...", log_file)
-            for message in adjusted_data:
-                c1, c2 = elgamal_encrypt(p, g, public_key, message)
-                encrypted_data.append((c1, c2))
-            
-            log_message(f"Saving encrypted data to '{encrypted_file}'...", log_file)
-            with open(encrypted_file, 'w') as f:
-                for c1, c2 in encrypted_data:
-                    f.write(f'{c1} {c2}\n')
+                    log_message(f"Prime number (p): {p}, Generator (g): {g}", log_file)
+
+                    # Generate keys
+                    private_key, public_key = generate_keys(p, g, log_file)
+
+                # Stream the audio through encryption into the container chunk by
+                # chunk, checkpointing each one so an interrupted run can resume
+                log_message(f"Encrypting '{input_file}' ({mode} mode) into '{encrypted_file}'...", log_file)
+                try:
+                    header = Container.encrypt_file_resumable(input_file, encrypted_file, mode, p, g, public_key,
+                                                              private_key=private_key)
+                except ValueError as e:
+                    log_message(f"Encryption failed: {e}", log_file)
+                    continue
+                params = header.params
+                log_message(f"Encrypted {params.nframes * params.nchannels} samples.", log_file)
+            report_metrics(log_file)
+            if profile:
+                log_message(f"Profile written to '{profile.path}'", log_file)
 
         elif option == '2':
             # Decryption
@@ -169,25 +228,63 @@ def main():
             with open(private_key_file, 'r') as f:
                 private_key = int(f.read().strip())
 
+            # Optionally decrypt only part of the audio
+            try:
+                time_range = input("Time range to decrypt in seconds as start-end "
+                                   "(leave blank for the whole file): ").strip()
+                time_range = parse_time_range(time_range) if time_range else None
+            except ValueError:
+                print("Invalid time range. Use start-end in seconds, e.g. 10-25.5")
+                continue
+
             # Load and decrypt the encrypted data
             log_message("Loading encrypted data for decryption...", log_file)
-            with open(encrypted_file, 'r') as f:
-                encrypted_data = []
-                for line in f:
-                    c1, c2 = map(int, line.strip().split())
-                    encrypted_data.append((c1, c2))
+            with Metrics.profiled('decrypt') as profile:
+                if time_range is not None:
+                    if not Container.is_container(encrypted_file):
+                        print("Time ranges can only be decrypted from container files.")
+                        continue
+                    # Only the chunks covering the range are read and decrypted
+                    start, end = time_range
+                    log_message(f"Decrypting {start}s to {'the end' if end is None else f'{end}s'} "
+                                f"into '{decrypted_file}'...", log_file)
+                    try:
+                        Container.decrypt_range(encrypted_file, private_key, decrypted_file, start, end)
+                    except ValueError as e:
+                        log_message(f"Decryption failed: {e}", log_file)
+                        continue
+                elif Container.is_container(encrypted_file):
+                    # Stream the container back into the output WAV chunk by chunk
+                    log_message(f"Decrypting into '{decrypted_file}'...", log_file)
+                    try:
+                        Container.decrypt_file(encrypted_file, private_key, decrypted_file)
+                    except ValueError as e:
+                        log_message(f"Decryption failed: {e}", log_file)
+                        continue
+                elif p is not None:
+                    # Legacy text files are imported with this session's key and WAV parameters
+                    header, chunks = Container.import_text(encrypted_file, p, g, public_key, params)
+                    log_message("Decrypting binary data...", log_file)
+                    try:
+                        decrypted_data = Container.decrypt_samples(header, private_key, chunks)
+                    except ValueError as e:
+                        log_message(f"Decryption failed: {e}", log_file)
+                        continue
 
-            decrypted_data = []
-            log_message("Decrypting binary data...", log_file)
-            for c1, c2 in encrypted_data:
-                message = elgamal_decrypt(p, private_key, c1, c2)
-                decrypted_data.append(message)
+                    # Adjust decrypted sample values back to original range
+                    recovered_data = Audio.from_offset(decrypted_data, header.params.sampwidth)
 
-            # Adjust decrypted sample values back to original range
-            recovered_data = [int(message - 32768) for message in decrypted_data]
-
-            # Convert binary back to audio
-            binary_to_audio(recovered_data, params, decrypted_file, log_file)
+                    # Convert binary back to audio
+                    binary_to_audio(recovered_data, header.params, decrypted_file, log_file)
+                else:
+                    print("Text ciphertext files can only be imported after an encryption in this session.")
+                    continue
+            report_metrics(log_file)
+            if profile:
+                log_message(f"Profile written to '{profile.path}'", log_file)
+            if time_range is not None:
+                # A partial decryption cannot be compared with the whole original
+                continue
 
             # Compare original and decrypted audio files
             log_message("Comparing original and decrypted audio files...", log_file)
@@ -196,18 +293,21 @@ def main():
                 print("Original audio file does not exist. Please check the path.")
                 continue
             
-            with wave.open(input_file_for_comparison, 'rb') as wave_file1:
-                with wave.open(decrypted_file, 'rb') as wave_file2:
-                    audio_data1 = wave_file1.readframes(wave_file1.getnframes())
-                    audio_data2 = wave_file2.readframes(wave_file2.getnframes())
-                    if audio_data1 == audio_data2:
-                        log_message('Decrypted audio file matches original audio file.', log_file)
-                    else:
-                        log_message('Decrypted audio file does not match original audio file.', log_file)
-                        log_message(f"Original audio file size: {len(audio_data1)} bytes", log_file)
-                        log_message(f"Decrypted audio file size: {len(audio_data2)} bytes", log_file)
-                        log_message(f"First few bytes of original file: {audio_data1[:100]}", log_file)
-                        log_message(f"First few bytes of decrypted file: {audio_data2[:100]}", log_file)
+            # Streamed comparison: constant memory however long the files are
+            try:
+                result = Audio.compare_audio(input_file_for_comparison, decrypted_file)
+            except (ValueError, wave.Error, EOFError) as e:
+                log_message(f"Decrypted audio file does not match original audio file: {e}", log_file)
+                continue
+            if result['bit_exact']:
+                log_message('Decrypted audio file matches original audio file.', log_file)
+            else:
+                log_message('Decrypted audio file does not match original audio file.', log_file)
+                log_message(f"SNR: {result['snr']:.2f} dB (per channel: "
+                            f"{', '.join(f'{snr:.2f}' for snr in result['channel_snr'])})", log_file)
+                log_message(f"Max absolute sample error: {result['max_abs_error']}", log_file)
+            log_message(f"BLAKE2b of original PCM data: {result['original_hash']}", log_file)
+            log_message(f"BLAKE2b of decrypted PCM data: {result['decrypted_hash']}", log_file)
 
         elif option == '3':
             # Exit
@@ -218,4 +318,8 @@ def main():
             print("Invalid option. Please choose 1, 2, or 3.")
 
 if __name__ == '__main__':
+    # With arguments, run the non-interactive batch commands instead (see Batch.py)
+    if len(sys.argv) > 1:
+        import Batch
+        sys.exit(Batch.main())
     main()
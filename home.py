@@ -1,25 +1,78 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, Response, request, jsonify, send_file, render_template, session, stream_with_context
+from itertools import chain
+import math
 import os
+import shutil
+import time
 import wave
 import struct
 import Audio
+import Backend
 import Elgamal
-import magic
-import numpy as np
+import Container
+import Jobs
+import KeyStore
+import Metrics
+import Pool
 
 app = Flask(__name__)
+# Set FLASK_SECRET_KEY when running several workers so sessions are shared
+app.secret_key = os.environ.get('FLASK_SECRET_KEY') or os.urandom(32)
 
 # Directory setup
 ENCRYPTED_DIR = 'encrypted_files'
 DECRYPTED_DIR = 'decrypted_files'
 PARAMS_FILE = 'audio_params.txt'
+ENCRYPTED_FILE = 'encrypted_data.bin'
+SOURCE_AUDIO = 'source_audio.wav'
+DECRYPTED_AUDIO = 'decrypted_audio.wav'
+UPLOADED_CIPHERTEXT = 'uploaded_ciphertext.bin'
 
-# Ensure directories exist
+# Ensure directories exist; each key id gets its own subdirectory of them
 os.makedirs(ENCRYPTED_DIR, exist_ok=True)
 os.makedirs(DECRYPTED_DIR, exist_ok=True)
 
-# In-memory storage for keys
-keys = {}
+# Per-session key storage (ELGAMAL_KEYSTORE=memory or sqlite:<path>)
+key_store = KeyStore.KeyStore()
+
+# Background encryption/decryption jobs
+jobs = Jobs.JobManager()
+
+# Request counters and timings, plus the opt-in profiler: with
+# ELGAMAL_PROFILING=1, add ?profile=1 to a request to write a cProfile file
+# for it (its path is returned in the X-Profile header)
+@app.before_request
+def start_request():
+    request.environ['elgamal.start'] = time.perf_counter()
+    if Metrics.PROFILING and request.args.get('profile'):
+        request.environ['elgamal.profile'] = Metrics.Profile(request.endpoint or 'unknown')
+
+@app.after_request
+def finish_request(response):
+    endpoint = request.endpoint or 'unknown'
+    Metrics.inc('elgamal_http_requests_total', endpoint=endpoint, status=response.status_code)
+    Metrics.observe('elgamal_http_request_seconds', time.perf_counter() - request.environ['elgamal.start'],
+                    endpoint=endpoint)
+    profile = request.environ.pop('elgamal.profile', None)
+    if profile is not None:
+        # Streamed bodies are produced after this hook, so stop when the response closes
+        response.call_on_close(profile.stop)
+        response.headers['X-Profile'] = profile.path
+    return response
+
+@app.teardown_request
+def abort_profile(error):
+    profile = request.environ.pop('elgamal.profile', None)
+    if profile is not None:
+        profile.stop()
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    backend = ('# HELP elgamal_backend_info Arithmetic backend in use\n'
+               '# TYPE elgamal_backend_info gauge\n'
+               f'elgamal_backend_info{{backend="{Backend.name}"}} 1\n')
+    return Response(Metrics.render() + backend, mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def home():
@@ -37,18 +90,58 @@ def demo():
 @app.route('/generate-keys', methods=['GET'])
 def generate_keys():
     private_key, public_key, p, g = Elgamal.elgamal_keygen(128)
-    keys['private_key'] = private_key
-    keys['public_key'] = public_key
-    keys['p'] = p
-    keys['g'] = g
+    purge_workspaces()
+    key_id = key_store.create(p, g, public_key, private_key)
+    session['key_id'] = key_id
+    # Start precomputing ephemeral pairs for this key in the background
+    Pool.get_pool(p, g, public_key, key_store.public_key(key_id))
     return jsonify({
+        'key_id': key_id,
         'public_key': str(public_key),
         'private_key': str(private_key)
     })
 
-# Audio to integers conversion
+# Key of the current session (or of an explicit key_id parameter)
+def current_key():
+    key_id = request.values.get('key_id') or session.get('key_id')
+    return key_id, key_store.get(key_id)
+
+# Working directory of a key id under `base`. The upload, container and
+# decrypted audio of one key are kept apart from every other key's, so
+# concurrent users never overwrite each other's files. Only ids found in
+# the key store are used, never raw request values.
+def workspace(base, key_id):
+    directory = os.path.join(base, key_id)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+# Remove the working directories of keys that have expired or been evicted
+def purge_workspaces():
+    for base in (ENCRYPTED_DIR, DECRYPTED_DIR):
+        for key_id in os.listdir(base):
+            path = os.path.join(base, key_id)
+            if os.path.isdir(path) and key_store.get(key_id) is None:
+                shutil.rmtree(path, ignore_errors=True)
+
+# Save WAV parameters for the later conversion steps
+def save_params(directory, params):
+    with open(os.path.join(directory, PARAMS_FILE), 'w') as param_file:
+        param_file.write(f"{params.nchannels} {params.sampwidth} {params.framerate} {params.nframes}")
+
+# Load the WAV parameters saved by save_params
+def load_params(directory):
+    param_path = os.path.join(directory, PARAMS_FILE)
+    with open(param_path, 'r') as param_file:
+        nchannels, sampwidth, framerate, nframes = map(int, param_file.read().split())
+    return wave._wave_params(nchannels, sampwidth, framerate, nframes, 'NONE', 'not compressed')
+
+# Audio upload and validation; the samples are streamed from this file at encryption time
 @app.route('/convert-to-integers', methods=['POST'])
 def convert_to_integers():
+    key_id, key = current_key()
+    if key is None:
+        return jsonify({'error': 'Keys not generated yet'}), 400
+
     if 'audio_file' not in request.files:
         return jsonify({'error': 'No audio file provided'}), 400
     
@@ -56,230 +149,407 @@ def convert_to_integers():
     if audio_file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    file_path = os.path.join(ENCRYPTED_DIR, audio_file.filename)
+    directory = workspace(ENCRYPTED_DIR, key_id)
+    file_path = os.path.join(directory, SOURCE_AUDIO)
     audio_file.save(file_path)
 
-    # Convert audio to binary
-    binary_data, params = Audio.audio_to_binary(file_path)
+    if not Audio.is_valid_wav_file(file_path):
+        os.remove(file_path)
+        return jsonify({'error': 'Uploaded file is not a valid WAV file.'}), 400
 
     # Save audio parameters for later use
-    with open(os.path.join(ENCRYPTED_DIR, PARAMS_FILE), 'w') as param_file:
-        param_file.write(f"{params.nchannels} {params.sampwidth} {params.framerate} {params.nframes}")
-
-    # Adjust audio samples before encryption (range 0-65535)
-    adjusted_data = [sample + 32768 for sample in binary_data]
-
-    # Save the adjusted binary data to a file
-    binary_file_path = os.path.join(ENCRYPTED_DIR, 'binary_data.txt')
-    with open(binary_file_path, 'w') as f:
-        for item in adjusted_data:
-            f.write(f"{item}\n")
+    save_params(directory, Audio.read_params(file_path))
 
     return jsonify({'success': True})
 
 # Encryption
 @app.route('/encrypt-audio', methods=['GET'])
 def encrypt_audio():
-    if 'public_key' not in keys or 'private_key' not in keys:
+    key_id, key = current_key()
+    if key is None:
         return jsonify({'error': 'Keys not generated yet'}), 400
 
-    public_key = keys['public_key']
-    p = keys['p']
-    g = keys['g']
-
-    encrypted_data = []
-    
-    # Read the binary data from file
-    binary_file_path = os.path.join(ENCRYPTED_DIR, 'binary_data.txt')
-    if not os.path.exists(binary_file_path):
-        return jsonify({'error': 'No binary data found. Please convert audio first.'}), 400
-    
-    with open(binary_file_path, 'r') as f:
-        binary_data = [int(line.strip()) for line in f.readlines()]
-    
-    # Encrypt each integer
-    for message in binary_data:
-        c1, c2 = Elgamal.elgamal_encrypt(p, g, public_key, message)
-        encrypted_data.append((c1, c2))
-    
-    # Save encrypted data to a file
-    encrypted_file_path = os.path.join(ENCRYPTED_DIR, 'encrypted_data.txt')
-    with open(encrypted_file_path, 'w') as f:
-        for c1, c2 in encrypted_data:
-            f.write(f"{c1} {c2}\n")
+    public_key = key['public_key']
+    p = key['p']
+    g = key['g']
+
+    directory = os.path.join(ENCRYPTED_DIR, key_id)
+    source_path = os.path.join(directory, SOURCE_AUDIO)
+    if not os.path.exists(source_path):
+        return jsonify({'error': 'No audio found. Please upload audio first.'}), 400
+
+    mode = request.args.get('mode', 'sample')
+    if mode not in Container.MODES:
+        return jsonify({'error': f'Unknown encryption mode: {mode}'}), 400
+
+    pool = Pool.get_pool(p, g, public_key, key_store.public_key(key_id))
+
+    if request.args.get('async'):
+        # Hand the upload over to a background job and return its id
+        params = Audio.read_params(source_path)
+        try:
+            job = jobs.create('encrypt', params.nframes * params.nchannels)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 503
+        job_source = job.path(SOURCE_AUDIO)
+        os.replace(source_path, job_source)
+
+        def run(job):
+            output_path = job.path(ENCRYPTED_FILE)
+            Container.encrypt_file(job_source, output_path, mode, p, g, public_key, pool=pool, progress=job.advance)
+            return output_path
+
+        jobs.submit(job, run)
+        return job_response(job)
+
+    # Stream the WAV through the selected mode (per sample, packed or hybrid)
+    # into the binary container, one checkpointed chunk at a time. If an
+    # earlier request for the same upload, key and mode died part way, the
+    # chunks it committed are kept and encryption carries on after them.
+    encrypted_file_path = os.path.join(directory, ENCRYPTED_FILE)
+    try:
+        Container.encrypt_file_resumable(source_path, encrypted_file_path, mode, p, g, public_key,
+                                         private_key=key['private_key'], pool=pool)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     return jsonify({'success': True})
 
+# Ephemeral pair pool statistics for the current key
+@app.route('/pool-stats', methods=['GET'])
+def pool_stats():
+    key_id, key = current_key()
+    if key is None:
+        return jsonify({'error': 'Keys not generated yet'}), 400
+    return jsonify(Pool.get_pool(key['p'], key['g'], key['public_key'], key_store.public_key(key_id)).stats())
+
 # Decryption
 @app.route('/decrypt-audio', methods=['POST'])
 def decrypt_audio():
     private_key = int(request.form['private_key'])
-    p = keys['p']
-
-    decrypted_data = []
 
     # Load encrypted data from file
     encrypted_file = request.files['encrypted_file']
-    file_path = os.path.join(DECRYPTED_DIR, encrypted_file.filename)
-    encrypted_file.save(file_path)
-
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        encrypted_data = []
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) != 2:
-                continue
-            try:
-                c1, c2 = map(int, parts)
-                encrypted_data.append((c1, c2))
-            except ValueError:
-                continue
-
-    if not encrypted_data:
-        return jsonify({'error': 'No valid encrypted data found.'}), 400
-
-    # Decrypt each data point
-    for c1, c2 in encrypted_data:
-        message = Elgamal.elgamal_decrypt(p, private_key, c1, c2)
-        decrypted_data.append(message)
-
-    # Adjust back to original range after decryption
-    adjusted_data = [int(message - 32768) for message in decrypted_data]
-
-    # Save decrypted integers to file for converting back to audio
-    decrypted_file_path = os.path.join(DECRYPTED_DIR, 'decrypted_data.txt')
-    with open(decrypted_file_path, 'w') as f:
-        for message in adjusted_data:
-            f.write(f"{message}\n")
+
+    if request.form.get('async'):
+        # Containers can be decrypted by a background job. The header is
+        # checked on the upload first, so a bad file never becomes a job.
+        try:
+            params = Container.read_header(encrypted_file.stream).params
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        encrypted_file.stream.seek(0)
+        try:
+            job = jobs.create('decrypt', params.nframes * params.nchannels)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 503
+        job_input = job.path(UPLOADED_CIPHERTEXT)
+        encrypted_file.save(job_input)
+
+        def run(job):
+            output_path = job.path(DECRYPTED_AUDIO)
+            Container.decrypt_file(job_input, private_key, output_path, progress=job.advance)
+            return output_path
+
+        jobs.submit(job, run)
+        return job_response(job)
+
+    key_id, key = current_key()
+    if key is None:
+        return jsonify({'error': 'Keys not generated yet (or use /decrypt-stream)'}), 400
+    decrypted_audio_path = os.path.join(workspace(DECRYPTED_DIR, key_id), DECRYPTED_AUDIO)
+    file_path = None
+    stream = encrypted_file.stream
+    is_container = stream.read(len(Container.MAGIC)) == Container.MAGIC
+    stream.seek(0)
+    try:
+        if is_container:
+            # Decrypt the uploaded container straight into the output WAV
+            header, body = Container.iter_decrypted(stream, private_key)
+            with open(decrypted_audio_path, 'wb') as f:
+                f.writelines(body)
+        else:
+            # Legacy text files only carry ciphertexts; import them with the session key
+            file_path = os.path.join(workspace(DECRYPTED_DIR, key_id), UPLOADED_CIPHERTEXT)
+            encrypted_file.save(file_path)
+            header, chunks = Container.import_text(file_path, key['p'], key['g'], key['public_key'],
+                                                   load_params(workspace(ENCRYPTED_DIR, key_id)))
+            if not chunks:
+                return jsonify({'error': 'No valid encrypted data found.'}), 400
+            decrypted_data = Container.decrypt_samples(header, private_key, chunks)
+            recovered_data = Audio.from_offset(decrypted_data, header.params.sampwidth)
+            Audio.binary_to_audio(recovered_data, header.params, decrypted_audio_path)
+    except (ValueError, OSError) as e:
+        if os.path.exists(decrypted_audio_path):
+            os.remove(decrypted_audio_path)
+        return jsonify({'error': str(e)}), 400
+    finally:
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+    # Keep the WAV parameters from the container
+    save_params(workspace(ENCRYPTED_DIR, key_id), header.params)
     
     return jsonify({'success': True})
 
-# Convert decrypted data to audio
+# Download the decrypted audio
 @app.route('/convert-to-audio', methods=['GET'])
 def convert_to_audio():
-    decrypted_file_path = os.path.join(DECRYPTED_DIR, 'decrypted_data.txt')
+    key_id, key = current_key()
+    if key is None:
+        return jsonify({'error': 'Keys not generated yet'}), 400
+    decrypted_audio_path = os.path.join(DECRYPTED_DIR, key_id, DECRYPTED_AUDIO)
 
-    if not os.path.exists(decrypted_file_path):
+    if not os.path.exists(decrypted_audio_path):
         return jsonify({'error': 'No decrypted data found.'}), 400
-    
-    with open(decrypted_file_path, 'r') as f:
-        decrypted_data = [int(line.strip()) for line in f]
 
-    # Load the original parameters
-    param_path = os.path.join(ENCRYPTED_DIR, PARAMS_FILE)
-    with open(param_path, 'r') as param_file:
-        nchannels, sampwidth, framerate, nframes = map(int, param_file.read().split())
-        params = wave._wave_params(nchannels, sampwidth, framerate, nframes, 'NONE', 'not compressed')
+    response = send_file(decrypted_audio_path, as_attachment=True)
+
+    # Clean up once the download has been sent
+    def cleanup():
+        shutil.rmtree(os.path.join(ENCRYPTED_DIR, key_id), ignore_errors=True)
+        shutil.rmtree(os.path.join(DECRYPTED_DIR, key_id), ignore_errors=True)
+    response.call_on_close(cleanup)
 
-    # Convert back to audio
-    decrypted_audio_path = os.path.join(DECRYPTED_DIR, 'decrypted_audio.wav')
-    Audio.binary_to_audio(decrypted_data, params, decrypted_audio_path)
+    return response
 
-    delete_files_in_directory(ENCRYPTED_DIR)
-    delete_files_in_directory(DECRYPTED_DIR)
+# Streamed encryption: the request body is the raw WAV file and the response
+# is the container, encrypted chunk by chunk without any temporary files
+@app.route('/encrypt-stream', methods=['POST'])
+def encrypt_stream():
+    key_id, key = current_key()
+    if key is None:
+        return jsonify({'error': 'Keys not generated yet'}), 400
 
-    return send_file(decrypted_audio_path, as_attachment=True)
+    mode = request.args.get('mode', 'sample')
+    if mode not in Container.MODES:
+        return jsonify({'error': f'Unknown encryption mode: {mode}'}), 400
+
+    try:
+        params, samples = Audio.open_samples(request.stream)
+    except (wave.Error, EOFError):
+        return jsonify({'error': 'Uploaded file is not a valid WAV file.'}), 400
+
+    p, g, public_key = key['p'], key['g'], key['public_key']
+    pool = Pool.get_pool(p, g, public_key, key_store.public_key(key_id))
+    sample_chunks = (Audio.to_offset(chunk, params.sampwidth) for chunk in samples)
+    body = Container.iter_encrypted(mode, p, g, public_key, params, sample_chunks, pool=pool)
+    try:
+        # Build the header up front so an unsupported format is reported as an error
+        first = next(body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_response(chain([first], body), ENCRYPTED_FILE, 'application/octet-stream')
+
+# Streamed decryption: the request body is the raw container and the response
+# is the WAV file. The private key comes from the X-Private-Key header, or
+# from the session key when the header is absent.
+@app.route('/decrypt-stream', methods=['POST'])
+def decrypt_stream():
+    private_key = request.headers.get('X-Private-Key')
+    if private_key is None:
+        _, key = current_key()
+        if key is None:
+            return jsonify({'error': 'No private key provided'}), 400
+        private_key = key['private_key']
+
+    try:
+        header, body = Container.iter_decrypted(request.stream, int(private_key))
+        # Decrypt the first chunk up front so a bad key or container is
+        # reported as an error. A failure in a later chunk (a corrupt or
+        # truncated container) can only abort the download once the 200 is
+        # sent, which the client sees as an incomplete transfer.
+        first = next(body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return stream_response(chain([first], body), DECRYPTED_AUDIO, 'audio/wav')
+
+# Decrypt a time range (?start=&end= in seconds) of the stored container,
+# or of an encryption job's result with ?job_id=, reading only the chunks
+# that cover it
+@app.route('/decrypt-range', methods=['GET'])
+def decrypt_range():
+    key_id, key = current_key()
+    private_key = request.headers.get('X-Private-Key')
+    if private_key is None:
+        if key is None:
+            return jsonify({'error': 'No private key provided'}), 400
+        private_key = key['private_key']
+
+    job_id = request.args.get('job_id')
+    if job_id:
+        job = jobs.get(job_id)
+        if job is None or job.kind != 'encrypt' or job.status != 'done':
+            return jsonify({'error': 'No finished encryption job with that id'}), 404
+        container_path = job.result_path
+    elif key is None:
+        return jsonify({'error': 'Keys not generated yet'}), 400
+    else:
+        container_path = os.path.join(ENCRYPTED_DIR, key_id, ENCRYPTED_FILE)
+    if not os.path.exists(container_path):
+        return jsonify({'error': 'No encrypted audio found'}), 400
+
+    try:
+        start = float(request.args.get('start', 0))
+        end = float(request.args['end']) if request.args.get('end') else None
+        with open(container_path, 'rb') as f:
+            params = Container.read_header(f).params
+        start_frame, end_frame = Container.frame_range(params, start, end)
+        params, sample_chunks = Container.open_range(container_path, int(private_key), start_frame, end_frame)
+        body = Audio.iter_wav_bytes(sample_chunks, params)
+        # Decrypt the first chunk up front so a bad key is reported as an error
+        first = next(body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return stream_response(chain([first], body), DECRYPTED_AUDIO, 'audio/wav')
+
+# Homomorphic analytics on an additive-mode container sent as the raw
+# request body: per-window sums (?window= in seconds) are computed from the
+# ciphertexts without any key. With ?decrypt=1 they are also decrypted, with
+# the X-Private-Key header or the session key, into the mean sample value
+# of each channel.
+@app.route('/aggregate', methods=['POST'])
+def aggregate():
+    private_key = None
+    if request.args.get('decrypt'):
+        private_key = request.headers.get('X-Private-Key')
+        if private_key is None:
+            _, key = current_key()
+            if key is None:
+                return jsonify({'error': 'No private key provided'}), 400
+            private_key = key['private_key']
+
+    try:
+        window = float(request.args.get('window', 1.0))
+        if not math.isfinite(window) or window <= 0:
+            raise ValueError("The window must be a positive number of seconds.")
+        header = Container.read_header(request.stream)
+        params = header.params
+        window_frames = max(1, round(window * params.framerate))
+        low = Audio.sample_range(params.sampwidth)[0]
+        windows = []
+        for first_frame, frames, sums in Container.iter_window_sums(request.stream, header, window_frames):
+            entry = {
+                'start': first_frame / params.framerate,
+                'frames': frames,
+                'sums': [[str(c1), str(c2)] for c1, c2 in sums],
+            }
+            if private_key is not None:
+                totals = Container.decrypt_window_sums(header, int(private_key), sums, frames)
+                entry['mean'] = [total / frames + low for total in totals]
+            windows.append(entry)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'window_frames': window_frames, 'channels': params.nchannels, 'windows': windows})
+
+# Streamed re-encryption: the request body is the raw container and the
+# response is the same audio under fresh randomness. With ?public_key= the
+# container is moved to that key, given the re-encryption key in the
+# X-Reencryption-Key header; hybrid containers need X-Private-Key instead.
+# Nothing is decrypted along the way, but the re-encryption key is as
+# secret as a private key: with the target's private key it gives the
+# source's (see Container.reencryption_key).
+@app.route('/reencrypt', methods=['POST'])
+def reencrypt():
+    try:
+        public_key = request.args.get('public_key')
+        public_key = int(public_key) if public_key else None
+        reencryption_key = int(request.headers.get('X-Reencryption-Key', 0))
+        private_key = request.headers.get('X-Private-Key')
+        private_key = int(private_key) if private_key else None
+        body = Container.iter_reencrypted(request.stream, public_key, reencryption_key, private_key)
+        # Re-encrypt the header up front so a bad key is reported as an error
+        first = next(body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_response(chain([first], body), ENCRYPTED_FILE, 'application/octet-stream')
+
+# Send a generator of bytes as a file download while keeping the request
+# stream readable
+def stream_response(body, filename, mimetype):
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def job_response(job):
+    return jsonify({
+        'job_id': job.id,
+        'status_url': f'/jobs/{job.id}',
+        'result_url': f'/jobs/{job.id}/result',
+    }), 202
+
+# Background job progress
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
+
+# Background job result (container for encryption, WAV for decryption)
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 409
+    return send_file(os.path.abspath(job.result_path), as_attachment=True)
 
 # Route to display the SNR page
 @app.route('/snr')
 def snr():
     return render_template('snr.html')
 
-# Function to check if the file is a valid WAV file
-def is_valid_wave(file_path):
+# Function to check if the file (path or file object) is a valid WAV file
+def is_valid_wave(wav_file):
     try:
-        with wave.open(file_path, 'rb') as wave_file:
+        with wave.open(wav_file, 'rb') as wave_file:
             # Check that the file has basic WAV properties
             params = wave_file.getparams()
             if params.nchannels > 0 and params.sampwidth > 0 and params.framerate > 0:
                 return True
-    except wave.Error:
+    except (wave.Error, EOFError):
         return False
+    finally:
+        if hasattr(wav_file, 'seek'):
+            wav_file.seek(0)
     return False
 
 # Function to calculate SNR
 def compute_snr(original_path, decrypted_path):
-    with wave.open(original_path, 'rb') as original_wave:
-        original_data = np.frombuffer(original_wave.readframes(-1), dtype=np.int16)
-    
-    with wave.open(decrypted_path, 'rb') as decrypted_wave:
-        decrypted_data = np.frombuffer(decrypted_wave.readframes(-1), dtype=np.int16)
-    
-    if len(original_data) != len(decrypted_data):
-        raise ValueError("The original and decrypted files have different lengths.")
-    
-    noise = original_data - decrypted_data
-    signal_power = np.sum(original_data ** 2)
-    noise_power = np.sum(noise ** 2)
-    
-    if noise_power == 0:
-        return float('inf')  # Infinite SNR means no noise
-    
-    snr = 10 * np.log10(signal_power / noise_power)
-    return snr
+    return Audio.compare_audio(original_path, decrypted_path)['snr']
+
+# JSON has no infinities; send them as strings
+def json_number(value):
+    if math.isinf(value):
+        return "Infinity" if value > 0 else "-Infinity"
+    return value
 
-# SNR calculation route
+# SNR calculation route. The uploads are compared chunk by chunk straight
+# from their per-request upload streams (spooled to private temp files by
+# the server), so concurrent requests never share files.
 @app.route('/calculate-snr', methods=['POST'])
 def calculate_snr():
-    # Save the files temporarily for processing
-    original_file = request.files['original_file']
-    decrypted_file = request.files['decrypted_file']
-    
-    # Ensure the 'temp' directory exists
-    temp_dir = 'temp'
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)  # Create 'temp' directory if it doesn't exist
-    
-    original_path = os.path.join(temp_dir, 'original.wav')
-    decrypted_path = os.path.join(temp_dir, 'decrypted.wav')
-    
-    # Save files to temp folder
-    original_file.save(original_path)
-    decrypted_file.save(decrypted_path)
-    
+    original_file = request.files['original_file'].stream
+    decrypted_file = request.files['decrypted_file'].stream
+
     # Validate if the files are valid WAV audio files
-    if not is_valid_wave(original_path) or not is_valid_wave(decrypted_path):
-        # Delete the files if they are not valid
-        if os.path.exists(original_path):
-            os.remove(original_path)
-        if os.path.exists(decrypted_path):
-            os.remove(decrypted_path)
+    if not is_valid_wave(original_file) or not is_valid_wave(decrypted_file):
         return jsonify({'error': 'Both files must be valid WAV format.'}), 400
-    
+
     try:
-        # Calculate SNR
-        snr_value = compute_snr(original_path, decrypted_path)
-        # Convert 'inf' or '-inf' to string for valid JSON
-        if np.isinf(snr_value):
-            snr_value = "Infinity" if snr_value > 0 else "-Infinity"
-        
-        result = jsonify({'snr': snr_value})
-        
-        # After calculation, remove the temporary files
-        if os.path.exists(original_path):
-            os.remove(original_path)
-        if os.path.exists(decrypted_path):
-            os.remove(decrypted_path)
-        
-        return result
+        result = Audio.compare_audio(original_file, decrypted_file)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': 'An error occurred during SNR calculation.'}), 500
-    finally:
-        # Ensure files are deleted in case of an error as well
-        if os.path.exists(original_path):
-            os.remove(original_path)
-        if os.path.exists(decrypted_path):
-            os.remove(decrypted_path)
-
-def delete_files_in_directory(directory):
-    #Delete all files in the given directory.
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        if os.path.isfile(file_path) or os.path.islink(file_path):
-            os.unlink(file_path)  # Remove the file
-            
+
+    result['snr'] = json_number(result['snr'])
+    result['channel_snr'] = [json_number(value) for value in result['channel_snr']]
+    return jsonify(result)
 
 if __name__ == '__main__':
     app.run(debug=True)